@@ -17,13 +17,33 @@
 # You should have received a copy of the GNU General Public License
 # along with libclangpy.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
 from ctypes import *
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
 import platform
+import re
+import shlex
 import sys
+import threading
+import time
+import traceback
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 _lib_extension = { 'Darwin': '.dylib', 'Linux': '.so', 'Windows': '.dll' }
 _system = platform.system()
 _libclang = None
+_library_name = None
 _dynamic_types = {}
 
 version = None
@@ -70,8 +90,21 @@ class _CXSourceRange(Structure):
 class _CXUnsavedFile(Structure):
 	_fields_ = [
 		('filename', c_utf8_p),
-		('contents', c_utf8_p),
-		('length', c_uint)
+		('contents', c_void_p),
+		('length', c_ulong)
+	]
+
+class _CXTUResourceUsageEntry(Structure):
+	_fields_ = [
+		('kind', c_uint),
+		('amount', c_ulong)
+	]
+
+class _CXTUResourceUsage(Structure):
+	_fields_ = [
+		('data', c_void_p),
+		('numEntries', c_uint),
+		('entries', POINTER(_CXTUResourceUsageEntry))
 	]
 
 class _CXToken(Structure):
@@ -89,6 +122,12 @@ class _CXCursor27(Structure):
 	def __hash__(self):
 		return hash((self.kind, self.data[0], self.data[1], self.data[2]))
 
+	def __eq__(self, other):
+		return self.kind == other.kind and self.data[0] == other.data[0] and self.data[1] == other.data[1] and self.data[2] == other.data[2]
+
+	def __ne__(self, other):
+		return not self == other
+
 class _CXCursor30(Structure):
 	_fields_ = [
 		('kind', c_uint),
@@ -99,6 +138,12 @@ class _CXCursor30(Structure):
 	def __hash__(self):
 		return hash((self.kind, self.xdata, self.data[0], self.data[1], self.data[2]))
 
+	def __eq__(self, other):
+		return self.kind == other.kind and self.xdata == other.xdata and self.data[0] == other.data[0] and self.data[1] == other.data[1] and self.data[2] == other.data[2]
+
+	def __ne__(self, other):
+		return not self == other
+
 class _CXType(Structure):
 	_fields_ = [
 		('kind', c_uint),
@@ -115,18 +160,42 @@ def _marshall_args(args):
 		ret[i] = arg.encode('utf-8')
 	return len(args), ret
 
+def _unsaved_contents(contents, buffers):
+	if not isinstance(contents, (bytes, bytearray, memoryview, mmap.mmap)):
+		contents = contents.encode('utf-8')
+	if not isinstance(contents, bytes):
+		# Writable buffers are passed to libclang directly. Read-only
+		# buffers (e.g. memoryview of bytes) need to be copied.
+		length = getattr(contents, 'nbytes', len(contents))
+		try:
+			data = (c_char * length).from_buffer(contents)
+			buffers.append(data)
+			return addressof(data), length
+		except TypeError:
+			if isinstance(contents, memoryview):
+				contents = contents.tobytes()
+			else:
+				contents = contents[:]
+	data = c_char_p(contents)
+	buffers.append(data)
+	return cast(data, c_void_p).value, len(contents)
+
 def _marshall_unsaved_files(unsaved_files):
 	if not unsaved_files or len(unsaved_files) == 0:
 		return 0, None
 	ret = (_CXUnsavedFile * len(unsaved_files))()
+	# The contents are referenced by pointer, so the array needs to keep
+	# the buffers alive while it is in use.
+	ret._buffers = []
+	# The contents of the unsaved files, with file objects read, for the
+	# line tables of the translation unit.
+	ret._contents = {}
 	for i, (name, contents) in enumerate(unsaved_files):
-		if hasattr(contents, 'read'):
-			contents = contents.read().encode('utf-8')
-		else:
-			contents = contents.encode('utf-8')
+		if hasattr(contents, 'read') and not isinstance(contents, mmap.mmap):
+			contents = contents.read()
+		ret._contents[name] = contents
 		ret[i].filename = name.encode('utf-8')
-		ret[i].contents = contents
-		ret[i].length = len(contents)
+		ret[i].contents, ret[i].length = _unsaved_contents(contents, ret._buffers)
 	return len(unsaved_files), ret
 
 def _detect_version(name):
@@ -158,6 +227,8 @@ def load(name=None, version=None):
 	""" Load libclang from the specified name and/or version. """
 
 	global _libclang
+	global _library_name
+	global _null_cursor
 	if not name:
 		name = 'libclang'
 	if version:
@@ -166,6 +237,7 @@ def load(name=None, version=None):
 	if not name.endswith(ext):
 		name = '{0}{1}'.format(name, ext)
 	_libclang = cdll.LoadLibrary(name)
+	_library_name = name
 	lib_version = _detect_version(name)
 	if lib_version >= 3.0:
 		_dynamic_types['_CXCursor'] = _CXCursor30
@@ -177,6 +249,10 @@ def load(name=None, version=None):
 		_dynamic_types['_CXCursor*'] = POINTER(_CXCursor27)
 		_dynamic_types['_CXCursor**'] = POINTER(POINTER(_CXCursor27))
 		_dynamic_types['cb_cursor_visitor'] = CFUNCTYPE(c_int, _CXCursor27, _CXCursor27, py_object)
+	_bind_apis()
+	_precompute_kind_properties()
+	_select_fixups()
+	_null_cursor = None
 
 class MissingFunction(Exception):
 	""" The requested function was not found in the loaded libclang library. """
@@ -188,69 +264,127 @@ def _map_type(t):
 		return _dynamic_types[t]
 	return t
 
-def _bind_api(name, argtypes, restype):
-	global _libclang
-	try:
-		api = getattr(_libclang, name)
-	except AttributeError:
+_apis = {}
+
+def _register_api(version, name, argtypes, restype, optional=False):
+	_apis[name] = (version, argtypes, restype, optional)
+
+def _missing_api(name):
+	def call(*args, **kwargs):
 		raise MissingFunction('Function %s not supported in this version of libclang.' % name)
+	return call
 
+def _bind_api(name, argtypes, restype, optional=False):
 	try:
-		registered = api.registered
+		api = getattr(_libclang, name)
 	except AttributeError:
-		registered = False
-
-	if not registered and api:
+		if optional:
+			setattr(_libclang, name, None)
+		else:
+			setattr(_libclang, name, _missing_api(name))
+		return
+	if argtypes is not None:
 		api.argtypes = [_map_type(x) for x in argtypes]
-		api.restype = _map_type(restype)
-		api.registered = True
+	api.restype = _map_type(restype)
+
+def _bind_apis():
+	for name, (version, argtypes, restype, optional) in _apis.items():
+		_bind_api(name, argtypes, restype, optional)
 
 def requires(version, name=None, argtypes=None, restype=None):
 	""" Python decorator to annotate required libclang API call dependencies, or libclang version. """
 
+	if name:
+		_register_api(version, name, argtypes, restype)
 	def new(f):
-		def call(*args, **kwargs):
-			if name:
-				_bind_api(name, argtypes=argtypes, restype=restype)
-			return f(*args, **kwargs)
-		return call
+		return f
 	return new
 
 def optional(version, name, argtypes=None, restype=None):
 	""" Python decorator to annotate optional libclang API call dependencies. """
 
+	_register_api(version, name, argtypes, restype, optional=True)
 	def new(f):
-		def call(*args, **kwargs):
-			global _libclang
-			try:
-				_bind_api(name, argtypes=argtypes, restype=restype)
-			except MissingFunction:
-				setattr(_libclang, name, None)
-			return f(*args, **kwargs)
-		return call
+		return f
 	return new
 
 def deprecated(version, message):
 	""" Python decorator to annotate libclang APIs that have been deprecated. """
 
 	def new(f):
-		def call(*args, **kwargs):
-			return f(*args, **kwargs)
-		return call
+		return f
 	return new
 
 class cached_property(object):
+	""" Cache the property value in the `_cached_<name>` slot of the instance. """
+
 	def __init__(self, wrapped):
 		self.wrapped = wrapped
+		self.slot = '_cached_{0}'.format(wrapped.__name__)
 		self.__doc__ = wrapped.__doc__
 
 	def __get__(self, instance, instance_type):
 		if instance is None:
 			return self
+		try:
+			return getattr(instance, self.slot)
+		except AttributeError:
+			pass
 		value = self.wrapped(instance)
-		setattr(instance, self.wrapped.__name__, value)
+		setattr(instance, self.slot, value)
 		return value
 
+	def reset(self, instance):
+		try:
+			delattr(instance, self.slot)
+		except AttributeError:
+			pass
+
+class LRUCache(object):
+	""" A mapping that holds at most max_size items, evicting the least recently used. """
+
+	def __init__(self, max_size=None):
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def get(self, key, default=None):
+		with self._lock:
+			try:
+				value = self._items.pop(key)
+			except KeyError:
+				self.misses = self.misses + 1
+				return default
+			self._items[key] = value
+			self.hits = self.hits + 1
+			return value
+
+	def add(self, key, value):
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = value
+			if self.max_size is not None:
+				while len(self._items) > self.max_size:
+					self._items.popitem(last=False)
+					self.evictions = self.evictions + 1
+
+	def remove(self, key):
+		with self._lock:
+			return self._items.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
 @requires(2.7, 'clang_getCString', [_CXString], c_utf8_p)
 @requires(2.7, 'clang_disposeString', [_CXString])
 def _to_str(s):
@@ -258,10 +392,57 @@ def _to_str(s):
 	_libclang.clang_disposeString(s)
 	return ret
 
-class File:
+class LineTable(object):
+	""" The offset of the start of each line of a file, for converting between offsets and lines and columns. """
+	__slots__ = ('starts', 'size')
+
+	def __init__(self, contents):
+		if isinstance(contents, memoryview):
+			contents = contents.tobytes()
+		elif not isinstance(contents, (bytes, bytearray, mmap.mmap)):
+			contents = contents.encode('utf-8')
+		starts = array('I', [0])
+		pos = contents.find(b'\n')
+		while pos != -1:
+			starts.append(pos + 1)
+			pos = contents.find(b'\n', pos + 1)
+		self.starts = starts
+		self.size = len(contents)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def location(self, offset):
+		""" The 1-based (line, column) of the offset. """
+		if offset < 0 or offset > self.size:
+			raise ValueError('Offset {0} is outside the file (size {1}).'.format(offset, self.size))
+		line = bisect_right(self.starts, offset)
+		return line, int(offset - self.starts[line - 1]) + 1
+
+	def offset(self, line, column):
+		""" The offset of the 1-based line and column. """
+		if line < 1 or line > len(self.starts):
+			raise ValueError('Line {0} is outside the file (1 to {1}).'.format(line, len(self.starts)))
+		start = self.starts[line - 1]
+		end = self.starts[line] - 1 if line < len(self.starts) else self.size
+		if column < 1 or column > end - start + 1:
+			raise ValueError('Column {0} is outside line {1} (1 to {2}).'.format(column, line, end - start + 1))
+		return int(start) + column - 1
+
+class File(object):
+	__slots__ = ('_f', '_contents', '_cached_name', '_cached_line_table')
+
+	# The translation unit interns File objects on the CXFile pointer (see
+	# TranslationUnit._file), so the files returned by the same translation
+	# unit are normally the same object. It also sets the contents of the
+	# unsaved files, which the line table is built from.
+
 	@requires(2.7)
 	def __init__(self, f):
+		if isinstance(f, c_void_p):
+			f = f.value
 		self._f = f
+		self._contents = None
 
 	@requires(2.7)
 	def __str__(self):
@@ -269,15 +450,23 @@ class File:
 
 	@requires(2.7)
 	def __eq__(self, other):
+		if self is other:
+			return True
 		if isinstance(other, str):
 			return self.name == other
+		if not isinstance(other, File):
+			return False
 		return self.name == other.name
 
 	@requires(2.7)
 	def __ne__(self, other):
 		return not self == other
 
-	@property
+	@requires(2.7)
+	def __hash__(self):
+		return hash(self.name)
+
+	@cached_property
 	@requires(2.7, 'clang_getFileName', [c_void_p], _CXString)
 	def name(self):
 		ret = _libclang.clang_getFileName(self._f)
@@ -288,10 +477,23 @@ class File:
 	def time(self):
 		return _libclang.clang_getFileTime(self._f)
 
-class SourceLocationData:
-	def __init__(self, l, c, o, cxfile=None, filename=None):
+	@cached_property
+	@requires(2.7)
+	def line_table(self):
+		if self._contents is not None:
+			contents, self._contents = self._contents, None
+			return LineTable(contents)
+		with open(self.name, 'rb') as f:
+			return LineTable(f.read())
+
+class SourceLocationData(object):
+	__slots__ = ('file', 'line', 'column', 'offset')
+
+	def __init__(self, l, c, o, cxfile=None, filename=None, tu=None):
 		if filename:
 			self.file = _to_str(filename)
+		elif cxfile and tu is not None:
+			self.file = tu._file(cxfile.value)
 		elif cxfile:
 			self.file = File(cxfile)
 		else:
@@ -300,10 +502,15 @@ class SourceLocationData:
 		self.column = int(c.value)
 		self.offset = int(o.value)
 
-class SourceLocation:
+class SourceLocation(object):
+	__slots__ = ('_sl', '_tu', '_cached_instantiation_location',
+	             '_cached_spelling_location', '_cached_expansion_location',
+	             '_cached_presumed_location', '_cached_file_location')
+
 	@requires(2.7)
-	def __init__(self, sl):
+	def __init__(self, sl, tu=None):
 		self._sl = sl
+		self._tu = tu
 
 	@requires(2.7, 'clang_equalLocations', [_CXSourceLocation, _CXSourceLocation], c_uint)
 	def __eq__(self, other):
@@ -318,21 +525,21 @@ class SourceLocation:
 	def instantiation_location(self):
 		f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
 		_libclang.clang_getInstantiationLocation(self._sl, byref(f), byref(l), byref(c), byref(o))
-		return SourceLocationData(l, c, o, cxfile=f)
+		return SourceLocationData(l, c, o, cxfile=f, tu=self._tu)
 
 	@cached_property
 	@requires(2.9, 'clang_getSpellingLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
 	def spelling_location(self):
 		f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
 		_libclang.clang_getSpellingLocation(self._sl, byref(f), byref(l), byref(c), byref(o))
-		return SourceLocationData(l, c, o, cxfile=f)
+		return SourceLocationData(l, c, o, cxfile=f, tu=self._tu)
 
 	@cached_property
 	@requires(3.1, 'clang_getExpansionLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
 	def expansion_location(self):
 		f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
 		_libclang.clang_getExpansionLocation(self._sl, byref(f), byref(l), byref(c), byref(o))
-		return SourceLocationData(l, c, o, cxfile=f)
+		return SourceLocationData(l, c, o, cxfile=f, tu=self._tu)
 
 	@cached_property
 	@requires(3.0, 'clang_getPresumedLocation', [_CXSourceLocation, POINTER(_CXString), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
@@ -346,7 +553,7 @@ class SourceLocation:
 	def file_location(self):
 		f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
 		_libclang.clang_getFileLocation(self._sl, byref(f), byref(l), byref(c), byref(o))
-		return SourceLocationData(l, c, o, cxfile=f)
+		return SourceLocationData(l, c, o, cxfile=f, tu=self._tu)
 
 	@staticmethod
 	@requires(2.7, 'clang_getNullLocation', [], _CXSourceLocation)
@@ -389,7 +596,9 @@ class SourceLocation:
 	def is_from_main_file(self):
 		return bool(_libclang.clang_Location_isFromMainFile(self._sl))
 
-class SourceRange:
+class SourceRange(object):
+	__slots__ = ('_sr',)
+
 	@requires(2.7)
 	@requires(2.7, 'clang_getRange', [_CXSourceLocation, _CXSourceLocation], _CXSourceRange)
 	def __init__(self, start, end):
@@ -432,10 +641,12 @@ class SourceRange:
 	@property
 	@requires(2.7, 'clang_getRangeEnd', [_CXSourceRange], _CXSourceLocation)
 	def end(self):
-		sl = _libclang.clang_getRangeStart(self._sr)
+		sl = _libclang.clang_getRangeEnd(self._sr)
 		return SourceLocation(sl)
 
-class DiagnosticDisplayOptions:
+class DiagnosticDisplayOptions(object):
+	__slots__ = ('value',)
+
 	@requires(2.7)
 	def __init__(self, value):
 		self.value = value
@@ -473,7 +684,9 @@ DiagnosticDisplayOptions.OPTION = DiagnosticDisplayOptions(8) # 2.9
 DiagnosticDisplayOptions.CATEGORY_ID = DiagnosticDisplayOptions(16) # 2.9
 DiagnosticDisplayOptions.CATEGORY_NAME = DiagnosticDisplayOptions(32) # 2.9
 
-class DiagnosticSeverity:
+class DiagnosticSeverity(object):
+	__slots__ = ('value',)
+
 	@requires(2.7)
 	def __init__(self, value):
 		self.value = value
@@ -500,7 +713,9 @@ DiagnosticSeverity.WARNING = DiagnosticSeverity(2) # 2.7
 DiagnosticSeverity.ERROR = DiagnosticSeverity(3) # 2.7
 DiagnosticSeverity.FATAL = DiagnosticSeverity(4) # 2.7
 
-class DiagnosticCategory:
+class DiagnosticCategory(object):
+	__slots__ = ('value',)
+
 	@requires(2.9)
 	def __init__(self, value):
 		self.value = value
@@ -622,7 +837,55 @@ class Diagnostic:
 			return _to_str(s)
 		return self.category.name
 
-class Linkage:
+DiagnosticRecord = namedtuple('DiagnosticRecord', ['severity', 'filename', 'line', 'column', 'spelling', 'option', 'category', 'ranges', 'fixits'])
+
+@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+def _diagnostic_location(sl):
+	f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
+	_libclang.clang_getInstantiationLocation(sl, byref(f), byref(l), byref(c), byref(o))
+	return f.value, int(l.value), int(c.value)
+
+@requires(2.7, 'clang_getRangeStart', [_CXSourceRange], _CXSourceLocation)
+@requires(2.7, 'clang_getRangeEnd', [_CXSourceRange], _CXSourceLocation)
+def _diagnostic_range(sr):
+	f, sline, scol = _diagnostic_location(_libclang.clang_getRangeStart(sr))
+	f, eline, ecol = _diagnostic_location(_libclang.clang_getRangeEnd(sr))
+	return ((sline, scol), (eline, ecol))
+
+@requires(2.7, 'clang_getDiagnosticLocation', [c_void_p], _CXSourceLocation)
+@requires(2.7, 'clang_getDiagnosticSpelling', [c_void_p], _CXString)
+@requires(2.7, 'clang_getDiagnosticNumRanges', [c_void_p], c_uint)
+@requires(2.7, 'clang_getDiagnosticRange', [c_void_p, c_uint], _CXSourceRange)
+@requires(2.7, 'clang_getDiagnosticNumFixIts', [c_void_p], c_uint)
+@requires(2.7, 'clang_getDiagnosticFixIt', [c_void_p, c_uint, POINTER(_CXSourceRange)], _CXString)
+@requires(2.9, 'clang_getDiagnosticOption', [c_void_p, POINTER(_CXString)], _CXString)
+@requires(2.9, 'clang_getDiagnosticCategory', [c_void_p], c_uint)
+@optional(3.1, 'clang_getDiagnosticCategoryText', [c_void_p], _CXString)
+def _diagnostic_record(d, severity):
+	f, line, column = _diagnostic_location(_libclang.clang_getDiagnosticLocation(d))
+	spelling = _to_str(_libclang.clang_getDiagnosticSpelling(d))
+	option = None
+	category = None
+	if version >= 2.9:
+		option = _to_str(_libclang.clang_getDiagnosticOption(d, None))
+		if _libclang.clang_getDiagnosticCategoryText:
+			category = _to_str(_libclang.clang_getDiagnosticCategoryText(d))
+		else:
+			category = DiagnosticCategory(_libclang.clang_getDiagnosticCategory(d)).name
+	ranges = []
+	for i in range(0, _libclang.clang_getDiagnosticNumRanges(d)):
+		ranges.append(_diagnostic_range(_libclang.clang_getDiagnosticRange(d, i)))
+	fixits = []
+	for i in range(0, _libclang.clang_getDiagnosticNumFixIts(d)):
+		sr = _CXSourceRange()
+		s = _libclang.clang_getDiagnosticFixIt(d, i, byref(sr))
+		fixits.append((_diagnostic_range(sr), _to_str(s)))
+	filename = File(f).name if f else None
+	return DiagnosticRecord(severity, filename, line, column, spelling, option, category, ranges, fixits)
+
+class Linkage(object):
+	__slots__ = ('value',)
+
 	@requires(2.7)
 	def __init__(self, value):
 		self.value = value
@@ -649,10 +912,23 @@ Linkage.INTERNAL = Linkage(2) # 2.7
 Linkage.UNIQUE_EXTERNAL = Linkage(3) # 2.7
 Linkage.EXTERNAL = Linkage(4) # 2.7
 
-class TokenKind:
+class TokenKind(object):
+	__slots__ = ('value',)
+
+	_kinds = {}
+
 	@requires(2.7)
-	def __init__(self, value):
-		self.value = value
+	def __new__(cls, value):
+		try:
+			return cls._kinds[value]
+		except KeyError:
+			kind = object.__new__(cls)
+			kind.value = value
+			return cls._kinds.setdefault(value, kind)
+
+	@requires(2.7)
+	def __reduce__(self):
+		return (TokenKind, (self.value,))
 
 	@requires(2.7)
 	def __eq__(self, other):
@@ -676,13 +952,9 @@ TokenKind.IDENTIFIER = TokenKind(2) # 2.7
 TokenKind.LITERAL = TokenKind(3) # 2.7
 TokenKind.COMMENT = TokenKind(4) # 2.7
 
-TokenKind.PUNCTUATION = TokenKind(0) # 2.7
-TokenKind.KEYWORD = TokenKind(1) # 2.7
-TokenKind.IDENTIFIER = TokenKind(2) # 2.7
-TokenKind.LITERAL = TokenKind(3) # 2.7
-TokenKind.COMMENT = TokenKind(4) # 2.7
+class CallingConvention(object):
+	__slots__ = ('value',)
 
-class CallingConvention:
 	@requires(3.1)
 	def __init__(self, value):
 		self.value = value
@@ -716,7 +988,9 @@ CallingConvention.INTEL_OCL_BICC = CallingConvention(9) # 3.3
 CallingConvention.INVALID = CallingConvention(100) # 3.1
 CallingConvention.UNEXPOSED = CallingConvention(200) # 3.1
 
-class ObjCPropertyAttributes:
+class ObjCPropertyAttributes(object):
+	__slots__ = ('value',)
+
 	@requires(3.3)
 	def __init__(self, value):
 		self.value = value
@@ -755,7 +1029,9 @@ ObjCPropertyAttributes.WEAK = ObjCPropertyAttributes(512) # 3.3
 ObjCPropertyAttributes.STRONG = ObjCPropertyAttributes(1024) # 3.3
 ObjCPropertyAttributes.UNSAFE_UNRETAINED = ObjCPropertyAttributes(2048) # 3.3
 
-class ObjCDeclQualifierKind:
+class ObjCDeclQualifierKind(object):
+	__slots__ = ('value',)
+
 	@requires(3.3)
 	def __init__(self, value):
 		self.value = value
@@ -788,12 +1064,15 @@ ObjCDeclQualifierKind.BYCOPY = ObjCDeclQualifierKind(8) # 3.3
 ObjCDeclQualifierKind.BYREF = ObjCDeclQualifierKind(16) # 3.3
 ObjCDeclQualifierKind.ONEWAY = ObjCDeclQualifierKind(32) # 3.3
 
-class Token:
+class Token(object):
+	__slots__ = ('_t', '_tokens', '_tu', '_index', '_cached_cursor')
+
 	@requires(2.7)
-	def __init__(self, t, tokens, tu):
+	def __init__(self, t, tokens, tu, index=None):
 		self._t = t
 		self._tokens = tokens
 		self._tu = tu
+		self._index = index
 
 	@requires(2.7)
 	def __str__(self):
@@ -815,7 +1094,7 @@ class Token:
 	@requires(2.7, 'clang_getTokenLocation', [c_void_p, _CXToken], _CXSourceLocation)
 	def location(self):
 		sl = _libclang.clang_getTokenLocation(self._tu._tu, self._t)
-		return SourceLocation(sl)
+		return SourceLocation(sl, self._tu)
 
 	@property
 	@requires(2.7, 'clang_getTokenExtent', [c_void_p, _CXToken], _CXSourceRange)
@@ -826,6 +1105,8 @@ class Token:
 	@cached_property
 	@requires(2.7, 'clang_getCursor', [c_void_p, _CXSourceLocation], '_CXCursor')
 	def cursor(self):
+		if self._index is not None and self._tokens._cursors is not None:
+			return self._tokens._cursor_at(self._index)
 		# NOTE: This is doing what clang_annotateTokens does, but on one token only.
 		c = _libclang.clang_getCursor(self._tu._tu, self.location._sl)
 		return _cursor(c, None, self._tu)
@@ -840,10 +1121,18 @@ class TokenList:
 		else:
 			self._tokens = []
 		self._length = length
+		self._cursors = None
+		self._kinds = None
+		self._spellings = None
+		self._locations = None
+		self._text = None
 
 	@requires(2.7, 'clang_disposeTokens', [c_void_p, POINTER(_CXToken), c_uint])
 	def __del__(self):
-		_libclang.clang_disposeTokens(self._tu._tu, self._data, self._length)
+		# The translation unit may already have been disposed if both are
+		# collected as part of the same reference cycle.
+		if self._tu._tu:
+			_libclang.clang_disposeTokens(self._tu._tu, self._data, self._length)
 
 	@requires(2.7)
 	def __len__(self):
@@ -851,7 +1140,9 @@ class TokenList:
 
 	@requires(2.7)
 	def __getitem__(self, key):
-		return Token(self._tokens[key], self, self._tu)
+		if key < 0:
+			key = key + self._length
+		return Token(self._tokens[key], self, self._tu, key)
 
 	@requires(2.7)
 	def __iter__(self):
@@ -861,17 +1152,232 @@ class TokenList:
 	@requires(2.7)
 	def match(self, pos, kind, value=None):
 		try:
-			token = Token(self._tokens[pos], self, self._tu)
+			if self.kinds()[pos] != kind.value:
+				return False
 		except IndexError:
 			return False
-		if token.kind != kind:
-			return False
-		return not value or token.spelling == value
+		if not value:
+			return True
+		if self._spellings is not None:
+			return self._spellings[pos] == value
+		return Token(self._tokens[pos], self, self._tu).spelling == value
 
-class CursorKind:
 	@requires(2.7)
-	def __init__(self, value):
-		self.value = value
+	def kinds(self):
+		""" The TokenKind value of each token, read directly from the token data. """
+		if self._kinds is None:
+			if self._length:
+				# clang_getTokenKind returns int_data[0], so read that from
+				# each token without making a call per token.
+				stride = sizeof(_CXToken) // sizeof(c_uint)
+				data = (c_uint * (self._length * stride)).from_address(addressof(self._tokens))
+				self._kinds = array('B', data[0::stride])
+			else:
+				self._kinds = array('B')
+		return self._kinds
+
+	@requires(2.7, 'clang_getTokenSpelling', [c_void_p, _CXToken], _CXString)
+	def spellings(self):
+		if self._spellings is None:
+			strings = {}
+			tu = self._tu._tu
+			ret = []
+			for t in self._tokens:
+				s = _to_str(_libclang.clang_getTokenSpelling(tu, t))
+				ret.append(strings.setdefault(s, s))
+			self._spellings = ret
+		return self._spellings
+
+	@requires(2.7, 'clang_getTokenLocation', [c_void_p, _CXToken], _CXSourceLocation)
+	@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+	def _decode_locations(self):
+		if self._locations is None:
+			tu = self._tu._tu
+			lines = array('I')
+			columns = array('I')
+			offsets = array('I')
+			l = c_uint()
+			c = c_uint()
+			o = c_uint()
+			for t in self._tokens:
+				sl = _libclang.clang_getTokenLocation(tu, t)
+				_libclang.clang_getInstantiationLocation(sl, None, byref(l), byref(c), byref(o))
+				lines.append(l.value)
+				columns.append(c.value)
+				offsets.append(o.value)
+			self._locations = (lines, columns, offsets)
+		return self._locations
+
+	@requires(2.7)
+	def _pattern_text(self):
+		# Each token is encoded as a character for its kind followed by
+		# its spelling and a NUL, for matching with a TokenPattern.
+		if self._text is None:
+			parts = []
+			offsets = [0]
+			for kind, spelling in zip(self.kinds(), self.spellings()):
+				part = '{0}{1}\0'.format(chr(65 + kind), spelling)
+				parts.append(part)
+				offsets.append(offsets[-1] + len(part))
+			starts = dict([(offset, i) for i, offset in enumerate(offsets)])
+			self._text = (''.join(parts), offsets, starts)
+		return self._text
+
+	@requires(2.7)
+	def lines(self):
+		return self._decode_locations()[0]
+
+	@requires(2.7)
+	def columns(self):
+		return self._decode_locations()[1]
+
+	@requires(2.7)
+	def offsets(self):
+		return self._decode_locations()[2]
+
+	@requires(2.7, 'clang_annotateTokens', [c_void_p, POINTER(_CXToken), c_uint, c_void_p])
+	def annotate(self):
+		""" Map each token to its cursor, returning a list of the cursors in token order. """
+		if self._cursors is None:
+			cursors = (_map_type('_CXCursor') * self._length)()
+			if self._length:
+				_libclang.clang_annotateTokens(self._tu._tu, self._data, self._length, cursors)
+			self._cursors = cursors
+		return [self._cursor_at(i) for i in range(0, self._length)]
+
+	@requires(2.7)
+	def _cursor_at(self, index):
+		return _cursor(self._cursors[index], None, self._tu)
+
+class TokenMatch(object):
+	__slots__ = ('start', 'end', 'captures')
+
+	def __init__(self, start, end, captures):
+		self.start = start
+		self.end = end
+		self.captures = captures
+
+	def __repr__(self):
+		return 'TokenMatch({0}, {1}, {2})'.format(self.start, self.end, self.captures)
+
+class _TokenPatternGroup(object):
+	__slots__ = ('elements', 'min', 'max', 'name')
+
+	def __init__(self, elements, min=1, max=1, name=None):
+		self.elements = elements
+		self.min = min
+		self.max = max
+		self.name = name
+
+class TokenPattern(object):
+	""" A sequence of token kind and spelling constraints, compiled to a regular expression over a TokenList. """
+
+	# An element is a TokenKind, a spelling, a (kind, spelling) tuple where
+	# either may be None to match anything, a list of elements, or a group
+	# created by the optional, repeat or capture methods.
+
+	def __init__(self, *elements):
+		self.names = []
+		# Matches can only start at the beginning of a token.
+		self._re = re.compile('(?:^|(?<=\0))' + self._compile(elements))
+
+	@staticmethod
+	def optional(*elements):
+		return _TokenPatternGroup(elements, 0, 1)
+
+	@staticmethod
+	def repeat(element, min=0, max=None):
+		""" Repeat an element, or a list of elements, between min and max (unbounded if None) times. """
+		if not isinstance(element, list):
+			element = [element]
+		return _TokenPatternGroup(element, min, max)
+
+	@staticmethod
+	def capture(name, *elements):
+		return _TokenPatternGroup(elements, name=name)
+
+	def _compile(self, elements):
+		ret = []
+		for element in elements:
+			if isinstance(element, _TokenPatternGroup):
+				body = self._compile(element.elements)
+				if element.name:
+					self.names.append(element.name)
+					body = '(?P<{0}>{1})'.format(element.name, body)
+				else:
+					body = '(?:{0})'.format(body)
+				if element.max is None:
+					body = '{0}{{{1},}}'.format(body, element.min)
+				elif (element.min, element.max) != (1, 1):
+					body = '{0}{{{1},{2}}}'.format(body, element.min, element.max)
+				ret.append(body)
+				continue
+			if isinstance(element, list):
+				ret.append(self._compile(element))
+				continue
+			if isinstance(element, TokenKind):
+				kind, spelling = element, None
+			elif isinstance(element, tuple):
+				kind, spelling = element
+			else:
+				kind, spelling = None, element
+			if kind is None:
+				ret.append('[A-E]')
+			else:
+				ret.append(chr(65 + kind.value))
+			if spelling is None:
+				ret.append('[^\0]*\0')
+			else:
+				ret.append('{0}\0'.format(re.escape(spelling)))
+		return ''.join(ret)
+
+	def _match(self, m, starts):
+		captures = {}
+		for name in self.names:
+			if m.start(name) == -1:
+				captures[name] = None
+			else:
+				captures[name] = (starts[m.start(name)], starts[m.end(name)])
+		return TokenMatch(starts[m.start()], starts[m.end()], captures)
+
+	def match(self, tokens, pos=0):
+		""" Match the pattern at the token position, returning a TokenMatch or None. """
+		text, offsets, starts = tokens._pattern_text()
+		if pos < 0 or pos > len(tokens):
+			return None
+		m = self._re.match(text, offsets[pos])
+		if not m:
+			return None
+		return self._match(m, starts)
+
+	def scan(self, tokens):
+		""" Yield a TokenMatch for each non-overlapping, non-empty match in the tokens. """
+		text, offsets, starts = tokens._pattern_text()
+		for m in self._re.finditer(text):
+			if m.end() > m.start():
+				yield self._match(m, starts)
+
+class CursorKind(object):
+	__slots__ = ('value', '_cached_spelling', '_cached_is_declaration',
+	             '_cached_is_reference', '_cached_is_expression',
+	             '_cached_is_statement', '_cached_is_invalid',
+	             '_cached_is_translation_unit', '_cached_is_preprocessing',
+	             '_cached_is_unexposed', '_cached_is_attribute')
+
+	_kinds = {}
+
+	@requires(2.7)
+	def __new__(cls, value):
+		try:
+			return cls._kinds[value]
+		except KeyError:
+			kind = object.__new__(cls)
+			kind.value = value
+			return cls._kinds.setdefault(value, kind)
+
+	@requires(2.7)
+	def __reduce__(self):
+		return (CursorKind, (self.value,))
 
 	@requires(2.7)
 	def __str__(self):
@@ -893,53 +1399,53 @@ class CursorKind:
 	def __repr__(self):
 		return 'CursorKind({0}|{1})'.format(self.value, self.spelling)
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_getCursorKindSpelling', [c_uint], _CXString)
 	def spelling(self):
 		s = _libclang.clang_getCursorKindSpelling(self.value)
 		return _to_str(s)
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isDeclaration', [c_uint], c_uint)
 	def is_declaration(self):
 		return bool(_libclang.clang_isDeclaration(self.value))
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isReference', [c_uint], c_uint)
 	def is_reference(self):
 		return bool(_libclang.clang_isReference(self.value))
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isExpression', [c_uint], c_uint)
 	def is_expression(self):
 		return bool(_libclang.clang_isExpression(self.value))
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isStatement', [c_uint], c_uint)
 	def is_statement(self):
 		return bool(_libclang.clang_isStatement(self.value))
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isInvalid', [c_uint], c_uint)
 	def is_invalid(self):
 		return bool(_libclang.clang_isInvalid(self.value))
 
-	@property
+	@cached_property
 	@requires(2.7, 'clang_isTranslationUnit', [c_uint], c_uint)
 	def is_translation_unit(self):
 		return bool(_libclang.clang_isTranslationUnit(self.value))
 
-	@property
+	@cached_property
 	@requires(2.8, 'clang_isPreprocessing', [c_uint], c_uint)
 	def is_preprocessing(self):
 		return bool(_libclang.clang_isPreprocessing(self.value))
 
-	@property
+	@cached_property
 	@requires(2.8, 'clang_isUnexposed', [c_uint], c_uint)
 	def is_unexposed(self):
 		return bool(_libclang.clang_isUnexposed(self.value))
 
-	@property
+	@cached_property
 	@requires(3.0, 'clang_isAttribute', [c_uint], c_uint)
 	def is_attribute(self):
 		return bool(_libclang.clang_isAttribute(self.value))
@@ -1126,10 +1632,23 @@ CursorKind.INCLUSION_DIRECTIVE = CursorKind(503) # 2.9
 
 CursorKind.MODULE_IMPORT_DECL = CursorKind(600) # 3.2
 
-class TypeKind:
+class TypeKind(object):
+	__slots__ = ('value', '_cached_spelling')
+
+	_kinds = {}
+
 	@requires(2.8)
-	def __init__(self, value):
-		self.value = value
+	def __new__(cls, value):
+		try:
+			return cls._kinds[value]
+		except KeyError:
+			kind = object.__new__(cls)
+			kind.value = value
+			return cls._kinds.setdefault(value, kind)
+
+	@requires(2.8)
+	def __reduce__(self):
+		return (TypeKind, (self.value,))
 
 	@requires(2.8)
 	def __eq__(self, other):
@@ -1151,7 +1670,7 @@ class TypeKind:
 	def __repr__(self):
 		return 'TypeKind({0}|{1})'.format(self.value, self.spelling)
 
-	@property
+	@cached_property
 	@requires(2.8, 'clang_getTypeKindSpelling', [c_uint], _CXString)
 	def spelling(self):
 		s = _libclang.clang_getTypeKindSpelling(self.value)
@@ -1207,7 +1726,28 @@ TypeKind.VARIABLE_ARRAY = TypeKind(115) # 3.4
 TypeKind.DEPENDENT_SIZED_ARRAY = TypeKind(116) # 3.4
 TypeKind.MEMBER_POINTER = TypeKind(117) # 3.4
 
-class RefQualifierKind:
+_kind_properties = [
+	(CursorKind, ['spelling', 'is_declaration', 'is_reference', 'is_expression',
+	              'is_statement', 'is_invalid', 'is_translation_unit',
+	              'is_preprocessing', 'is_unexposed', 'is_attribute']),
+	(TypeKind, ['spelling']),
+]
+
+def _precompute_kind_properties():
+	# The kind properties are fixed for a given libclang library, so they
+	# are evaluated once here instead of calling into libclang each time.
+	for cls, properties in _kind_properties:
+		for kind in list(cls._kinds.values()):
+			for name in properties:
+				getattr(cls, name).reset(kind)
+				try:
+					getattr(kind, name)
+				except MissingFunction:
+					pass
+
+class RefQualifierKind(object):
+	__slots__ = ('value',)
+
 	@requires(3.4)
 	def __init__(self, value):
 		self.value = value
@@ -1232,21 +1772,136 @@ RefQualifierKind.NONE = RefQualifierKind(0) # 3.4
 RefQualifierKind.LVALUE = RefQualifierKind(1) # 3.4
 RefQualifierKind.RVALUE = RefQualifierKind(2) # 3.4
 
-class Type:
+RecordLayout = namedtuple('RecordLayout', ['type', 'size', 'alignment', 'fields'])
+
+FieldLayout = namedtuple('FieldLayout', ['field', 'offset', 'bit_width', 'type'])
+
+_record_kinds = [
+	CursorKind.STRUCT_DECL,
+	CursorKind.UNION_DECL,
+	CursorKind.CLASS_DECL]
+
+_layout_kinds = _record_kinds + [CursorKind.FIELD_DECL]
+
+def _record_fields(cursors):
+	""" Yield the (record, fields) of each record in a preorder walk over _layout_kinds. """
+	# The fields are (field, direct) pairs, where direct is False for the
+	# fields of anonymous struct/union members. Those fields are part of
+	# the enclosing record, but the type of an unnamed struct/union used
+	# by a named field is not. A record is complete when the walk leaves
+	# it, and the records are yielded in preorder when the outermost
+	# record is complete.
+	stack = []
+	ret = []
+	def complete():
+		record, depth, items, index = stack.pop()
+		fields = []
+		declarations = None
+		for c, nested in items:
+			if nested is None:
+				fields.append((c, True))
+				continue
+			if declarations is None:
+				declarations = set([f.type.canonical_type.declaration for f, n in items if n is None])
+			if c not in declarations:
+				fields.extend([(f, False) for f, direct in nested])
+		ret[index] = (record, fields)
+		if stack and not record.spelling and record.parent == stack[-1][0]:
+			stack[-1][2].append((record, fields))
+	for c, depth in cursors:
+		while stack and stack[-1][1] >= depth:
+			complete()
+			if not stack:
+				for record in ret:
+					yield record
+				del ret[:]
+		if c.kind == CursorKind.FIELD_DECL:
+			if stack and c.parent == stack[-1][0]:
+				stack[-1][2].append((c, None))
+		else:
+			stack.append((c, depth, [], len(ret)))
+			ret.append(None)
+	while stack:
+		complete()
+	for record in ret:
+		yield record
+
+def _fields_of(record):
+	cursors = [(record, 0)] + record.walk(kinds=_layout_kinds)
+	for c, fields in _record_fields(cursors):
+		return fields
+
+@optional(3.7, 'clang_Cursor_getOffsetOfField', ['_CXCursor'], c_longlong)
+def _field_offset(t, field, direct):
+	if direct and _libclang.clang_Cursor_getOffsetOfField:
+		offset = _libclang.clang_Cursor_getOffsetOfField(field._c)
+	elif field.spelling:
+		offset = t.offset(field.spelling)
+	else: # unnamed bit-fields cannot be looked up by name
+		return None
+	if offset < 0:
+		return None
+	return offset
+
+class _TypeData(object):
+	""" The data of a type that does not depend on the cursor it was obtained from. """
+	__slots__ = ('kind', 'cls', 'args', 'types', 'declaration', 'layout')
+
+	def __init__(self, kind):
+		self.kind = kind
+		self.cls, self.args = _type_classes.get(kind.value, _default_type_class)
+		self.types = {}
+		self.declaration = None
+		self.layout = _not_computed
+
+_not_computed = object()
+
+class Type(object):
+	__slots__ = ('_t', '_key', '_data', 'kind', 'cursor', '_cached_canonical_type',
+	             '_cached_pointee_type', '_cached_result_type',
+	             '_cached_declaration', '_cached_array_element_type',
+	             '_cached_element_type')
+
 	@requires(2.8)
 	def __init__(self, t, kind, cursor):
 		self._t = t
+		# This matches clang_equalTypes, which only compares the data.
+		self._key = (t.data[0], t.data[1])
+		self._data = None
 		self.kind = kind
 		self.cursor = cursor
 
-	@requires(2.8, 'clang_equalTypes', [_CXType, _CXType], c_uint)
+	@requires(2.8)
 	def __eq__(self, other):
-		return bool(_libclang.clang_equalTypes(self._t, other._t))
+		if self is other:
+			return True
+		if not isinstance(other, Type):
+			return False
+		return self._key == other._key
 
 	@requires(2.8)
 	def __ne__(self, other):
 		return not self.__eq__(other)
 
+	@requires(2.8)
+	def __hash__(self):
+		return hash(self._key)
+
+	@requires(2.8)
+	def _derived_type(self, name, api):
+		# The derived CXType is shared by equal types, but the Type is
+		# created for this cursor as the INVALID type fixups use it.
+		data = self._data
+		if data is None:
+			t = api(self._t)
+		else:
+			try:
+				t = data.types[name]
+			except KeyError:
+				t = api(self._t)
+				data.types[name] = t
+		return _type(t, self.cursor)
+
 	@requires(3.3)
 	def __str__(self):
 		return self.spelling
@@ -1254,26 +1909,29 @@ class Type:
 	@cached_property
 	@requires(2.8, 'clang_getCanonicalType', [_CXType], _CXType)
 	def canonical_type(self):
-		t = _libclang.clang_getCanonicalType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('canonical_type', _libclang.clang_getCanonicalType)
 
 	@cached_property
 	@requires(2.8, 'clang_getPointeeType', [_CXType], _CXType)
 	def pointee_type(self):
-		t = _libclang.clang_getPointeeType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('pointee_type', _libclang.clang_getPointeeType)
 
 	@cached_property
 	@requires(2.8, 'clang_getResultType', [_CXType], _CXType)
 	def result_type(self):
-		t = _libclang.clang_getResultType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('result_type', _libclang.clang_getResultType)
 
 	@cached_property
 	@requires(2.8, 'clang_getTypeDeclaration', [_CXType], '_CXCursor')
 	def declaration(self):
+		data = self._data
+		if data is not None and data.declaration is not None:
+			return data.declaration
 		c = _libclang.clang_getTypeDeclaration(self._t)
-		return _cursor(c, None, self.cursor._tu)
+		ret = _cursor(c, None, self.cursor._tu)
+		if data is not None:
+			data.declaration = ret
+		return ret
 
 	@property
 	@requires(2.8, 'clang_isPODType', [_CXType], c_uint)
@@ -1298,8 +1956,7 @@ class Type:
 	@cached_property
 	@requires(3.0, 'clang_getArrayElementType', [_CXType], _CXType)
 	def array_element_type(self):
-		t = _libclang.clang_getArrayElementType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('array_element_type', _libclang.clang_getArrayElementType)
 
 	@property
 	@requires(3.0, 'clang_getArraySize', [_CXType], c_longlong)
@@ -1317,8 +1974,7 @@ class Type:
 	@cached_property
 	@requires(3.1, 'clang_getElementType', [_CXType], _CXType)
 	def element_type(self):
-		t = _libclang.clang_getElementType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('element_type', _libclang.clang_getElementType)
 
 	@property
 	@requires(3.1, 'clang_getNumElements', [_CXType], c_longlong)
@@ -1356,6 +2012,44 @@ class Type:
 	def offset(self, field):
 		return _libclang.clang_Type_getOffsetOf(self._t, field)
 
+	@requires(3.3)
+	def layout(self):
+		""" The RecordLayout of this type, or None if it is not a complete record. """
+		return self.canonical_type._layout()
+
+	@requires(3.3)
+	def _layout(self, fields=None):
+		# This is the canonical type. The fields are the (field, direct)
+		# pairs of the record from _record_fields, if they are known.
+		data = self._data
+		if data is not None and data.layout is not _not_computed:
+			return data.layout
+		ret = self._record_layout(fields)
+		if data is not None:
+			data.layout = ret
+		return ret
+
+	@requires(3.3)
+	def _record_layout(self, fields):
+		if self.kind != TypeKind.RECORD:
+			return None
+		size = self.size
+		if size < 0: # incomplete or dependent type
+			return None
+		record = self.declaration
+		if fields is None:
+			fields = _fields_of(record)
+		if not fields and not record.specialized_template.is_null:
+			# libclang does not visit the fields of implicit template
+			# instantiations, so use the fields of the template. The
+			# offsets are for this type, so are looked up by name, but
+			# the field types are the ones declared in the template.
+			fields = [(f, False) for f, direct in _fields_of(record.specialized_template)]
+		fields = [FieldLayout(f, _field_offset(self, f, direct), f.bit_field_width if f.is_bit_field else None, f.type) for f, direct in fields]
+		# The layout is shared by equal types, so it uses the type of the
+		# record declaration instead of this cursor.
+		return RecordLayout(_type(self._t, record), size, self.alignment, fields)
+
 	@property
 	@requires(3.4, 'clang_Type_getCXXRefQualifier', [_CXType], c_uint)
 	def cxx_ref_qualifier(self):
@@ -1371,6 +2065,9 @@ class Type:
 			yield _type(t, self.cursor)
 
 class BuiltinType(Type):
+	__slots__ = ('is_signed_integer', 'is_unsigned_integer',
+	             'is_floating_point')
+
 	@requires(2.8)
 	def __init__(self, t, kind, tu, signed_integer=False, unsigned_integer=False, floating_point=False):
 		Type.__init__(self, t, kind, tu)
@@ -1379,6 +2076,8 @@ class BuiltinType(Type):
 		self.is_floating_point = floating_point
 
 class FunctionProtoType(Type):
+	__slots__ = ()
+
 	@requires(2.8)
 	def __init__(self, t, kind, tu):
 		Type.__init__(self, t, kind, tu)
@@ -1390,6 +2089,8 @@ class FunctionProtoType(Type):
 		return RefQualifierKind(q)
 
 class MemberPointerType(Type):
+	__slots__ = ('_cached_class_type',)
+
 	@requires(3.4)
 	def __init__(self, t, kind, tu):
 		Type.__init__(self, t, kind, tu)
@@ -1397,12 +2098,43 @@ class MemberPointerType(Type):
 	@cached_property
 	@requires(3.4, 'clang_Type_getClassType', [_CXType], _CXType)
 	def class_type(self):
-		t = _libclang.clang_Type_getClassType(self._t)
-		return _type(t, self.cursor)
+		return self._derived_type('class_type', _libclang.clang_Type_getClassType)
+
+_unsigned_integer_types = frozenset([
+	TypeKind.BOOL,   TypeKind.CHAR_U, TypeKind.UCHAR,
+	TypeKind.CHAR16, TypeKind.CHAR32, TypeKind.USHORT,
+	TypeKind.UINT,   TypeKind.ULONG,  TypeKind.ULONGLONG,
+	TypeKind.UINT128])
+
+_signed_integer_types = frozenset([
+	TypeKind.CHAR_S,   TypeKind.SCHAR, TypeKind.WCHAR,
+	TypeKind.SHORT,    TypeKind.INT,   TypeKind.LONG,
+	TypeKind.LONGLONG, TypeKind.INT128])
+
+_floating_point_types = frozenset([
+	TypeKind.FLOAT, TypeKind.DOUBLE, TypeKind.LONG_DOUBLE])
+
+# The Type subclass and BuiltinType flags for each TypeKind value. Values
+# not in the table are created as a Type.
+
+_type_classes = {}
+
+for value in range(2, 100): # builtin type
+	_type_classes[value] = (BuiltinType, (False, False, False))
+for kind in _signed_integer_types:
+	_type_classes[kind.value] = (BuiltinType, (True, False, False))
+for kind in _unsigned_integer_types:
+	_type_classes[kind.value] = (BuiltinType, (False, True, False))
+for kind in _floating_point_types:
+	_type_classes[kind.value] = (BuiltinType, (False, False, True))
+_type_classes[TypeKind.FUNCTION_PROTO.value] = (FunctionProtoType, ())
+_type_classes[TypeKind.MEMBER_POINTER.value] = (MemberPointerType, ())
+
+_default_type_class = (Type, ())
 
 def _type(t, cursor):
-	kind = TypeKind(t.kind)
-	if kind == TypeKind.INVALID:
+	if t.kind == 0: # INVALID
+		kind = TypeKind.INVALID
 		if cursor.kind == CursorKind.OBJC_INTERFACE_DECL:
 			# libclang <= 2.8 does not identify the OBJC_INTERFACE type
 			kind = TypeKind.OBJC_INTERFACE
@@ -1412,26 +2144,29 @@ def _type(t, cursor):
 		elif cursor.kind == CursorKind.FUNCTION_TEMPLATE:
 			# libclang <= 3.2 does not identify the FUNCTION_PROTO type here
 			kind = TypeKind.FUNCTION_PROTO
-	if kind.value > 1 and kind.value < 100: # builtin type
-		if kind in [TypeKind.BOOL,   TypeKind.CHAR_U, TypeKind.UCHAR,
-		            TypeKind.CHAR16, TypeKind.CHAR32, TypeKind.USHORT,
-		            TypeKind.UINT,   TypeKind.ULONG,  TypeKind.ULONGLONG,
-		            TypeKind.UINT128]:
-			return BuiltinType(t, kind, cursor, unsigned_integer=True)
-		if kind in [TypeKind.CHAR_S,   TypeKind.SCHAR, TypeKind.WCHAR,
-		            TypeKind.SHORT,    TypeKind.INT,   TypeKind.LONG,
-		            TypeKind.LONGLONG, TypeKind.INT128]:
-			return BuiltinType(t, kind, cursor, signed_integer=True)
-		if kind in [TypeKind.FLOAT, TypeKind.DOUBLE, TypeKind.LONG_DOUBLE]:
-			return BuiltinType(t, kind, cursor, floating_point=True)
-		return BuiltinType(t, kind, cursor)
-	if kind == TypeKind.FUNCTION_PROTO:
-		return FunctionProtoType(t, kind, cursor)
-	if kind == TypeKind.MEMBER_POINTER:
-		return MemberPointerType(t, kind, cursor)
-	return Type(t, kind, cursor)
-
-class AvailabilityKind:
+		# The kind of these types depends on the cursor, so they are not
+		# shared with other cursors.
+		cls, args = _type_classes.get(kind.value, _default_type_class)
+		return cls(t, kind, cursor, *args)
+
+	# Equal types share their cursor independent data within a translation
+	# unit. The Type itself is created for each cursor, as Type.cursor and
+	# the fixups above depend on it.
+	tu = cursor._tu
+	if tu is None:
+		cls, args = _type_classes.get(t.kind, _default_type_class)
+		return cls(t, TypeKind(t.kind), cursor, *args)
+	key = (t.kind, t.data[0], t.data[1])
+	data = tu.type_cache.get(key)
+	if data is None:
+		data = tu.type_cache.setdefault(key, _TypeData(TypeKind(t.kind)))
+	ret = data.cls(t, data.kind, cursor, *data.args)
+	ret._data = data
+	return ret
+
+class AvailabilityKind(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -1457,7 +2192,9 @@ AvailabilityKind.DEPRECATED = AvailabilityKind(1) # 2.8
 AvailabilityKind.NOT_AVAILABLE = AvailabilityKind(2) # 2.8
 AvailabilityKind.NOT_ACCESSIBLE = AvailabilityKind(3) # 3.0
 
-class LanguageKind:
+class LanguageKind(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -1483,7 +2220,9 @@ LanguageKind.C = LanguageKind(1) # 2.8
 LanguageKind.OBJC = LanguageKind(2) # 2.8
 LanguageKind.C_PLUS_PLUS = LanguageKind(3) # 2.8
 
-class AccessSpecifier:
+class AccessSpecifier(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -1537,7 +2276,9 @@ class OverriddenCursors:
 		for i in range(0, len(self)):
 			yield self[i]
 
-class NameRefFlags:
+class NameRefFlags(object):
+	__slots__ = ('value',)
+
 	@requires(3.0)
 	def __init__(self, value):
 		self.value = value
@@ -1566,18 +2307,50 @@ NameRefFlags.WANT_QUALIFIER = NameRefFlags(1) # 3.0
 NameRefFlags.WANT_TEMPLATE_ARGS = NameRefFlags(2) # 3.0
 NameRefFlags.WANT_SINGLE_PIECE = NameRefFlags(4) # 3.0
 
-class Cursor:
+class Cursor(object):
+	__slots__ = ('_c', '_tu', 'parent', '_kind', '_fixups', '_access_specifier', '_cached__key',
+	             '_cached_children', '_cached_referenced', '_cached_definition',
+	             '_cached_tokens', '_cached__tokens_left_of_children',
+	             '_cached_type', '_cached_result_type',
+	             '_cached_ib_outlet_collection_type',
+	             '_cached_specialized_template', '_cached_semantic_parent',
+	             '_cached_lexical_parent', '_cached_canonical',
+	             '_cached_receiver_type')
+
 	@requires(2.7)
 	def __init__(self, c, kind, parent, tu):
 		self._c = c
 		self._tu = tu
 		self.parent = parent
-		self.kind = kind
+		self._kind = kind
+		self._fixups = None
 		self._access_specifier = None
 
-	@requires(2.7, 'clang_equalCursors', ['_CXCursor', '_CXCursor'], c_uint)
+	@requires(2.7)
+	def _apply_fixups(self):
+		fixups = self._fixups
+		self._fixups = None
+		for fixup in fixups:
+			if fixup(self):
+				return
+
+	@property
+	@requires(2.7)
+	def kind(self):
+		if self._fixups:
+			self._apply_fixups()
+		return self._kind
+
+	@cached_property
+	@requires(2.7)
+	def _key(self):
+		return _cursor_key(self._c)
+
+	@requires(2.7)
 	def __eq__(self, other):
-		return bool(_libclang.clang_equalCursors(self._c, other._c))
+		if not isinstance(other, Cursor):
+			return False
+		return self._key == other._key
 
 	@requires(2.7)
 	def __ne__(self, other):
@@ -1588,25 +2361,22 @@ class Cursor:
 		return self.spelling
 
 	@requires(2.7)
-	@optional(2.9, 'clang_hashCursor', ['_CXCursor'], c_uint)
 	def __hash__(self):
-		if _libclang.clang_hashCursor:
-			return _libclang.clang_hashCursor(self._c)
-		return hash((self._c.kind, self._c.data[0], self._c.data[1], self._c.data[2]))
+		return hash(self._key)
 
 	@staticmethod
 	@requires(2.7, 'clang_getNullCursor', [], '_CXCursor')
 	def null():
-		c = _libclang.clang_getNullCursor()
-		return _cursor(c, None, None)
+		global _null_cursor
+		if _null_cursor is None:
+			c = _libclang.clang_getNullCursor()
+			_null_cursor = _cursor(c, None, None)
+		return _null_cursor
 
 	@property
 	@requires(2.7)
-	@optional(3.0, 'clang_Cursor_isNull', ['_CXCursor'], c_int)
 	def is_null(self):
-		if _libclang.clang_Cursor_isNull:
-			return bool(_libclang.clang_Cursor_isNull(self._c))
-		return self == Cursor.null()
+		return self._key == _null_cursor_key
 
 	@property
 	@requires(2.7)
@@ -1625,7 +2395,7 @@ class Cursor:
 	@requires(2.7, 'clang_getCursorLocation', ['_CXCursor'], _CXSourceLocation)
 	def location(self):
 		sl = _libclang.clang_getCursorLocation(self._c)
-		return SourceLocation(sl)
+		return SourceLocation(sl, self._tu)
 
 	@property
 	@requires(2.7, 'clang_getCursorExtent', ['_CXCursor'], _CXSourceRange)
@@ -1633,31 +2403,109 @@ class Cursor:
 		sr = _libclang.clang_getCursorExtent(self._c)
 		return SourceRange(sr, None)
 
+	@requires(2.7)
+	def _visit_state(self):
+		state = {'parent': self, 'access_specifier': None}
+		if version <= 3.2:
+			# fix access_specifier on libclang <= 3.2 declarations ...
+			if self.kind == CursorKind.STRUCT_DECL or self.kind == CursorKind.UNION_DECL:
+				state['access_specifier'] = AccessSpecifier.PUBLIC
+			elif self.kind == CursorKind.CLASS_DECL:
+				state['access_specifier'] = AccessSpecifier.PRIVATE
+		return state
+
+	@requires(2.7)
+	def _visit_child(self, child, state):
+		if _cursor_key(child) == _null_cursor_key:
+			return None
+		kind = CursorKind(child.kind)
+		if kind in _own_access_specifier_kinds:
+			# libclang <= 3.2 correctly classifies these
+			c = _cursor(child, state['parent'], self._tu, None)
+		else:
+			c = _cursor(child, state['parent'], self._tu, state['access_specifier'])
+		if version <= 3.2 and c.kind == CursorKind.CXX_ACCESS_SPECIFIER:
+			# fix access_specifier on libclang <= 3.2 declarations ...
+			state['access_specifier'] = c.access_specifier
+		return c
+
 	@cached_property
 	@requires(2.7, 'clang_visitChildren', ['_CXCursor', 'cb_cursor_visitor', py_object], c_uint)
 	def children(self):
 		def visitor(child, parent_cursor, args):
-			kind = CursorKind(child.kind)
-			if kind in [CursorKind.CXX_ACCESS_SPECIFIER, CursorKind.CXX_BASE_SPECIFIER]:
-				# libclang <= 3.2 correctly classifies these
-				c = _cursor(child, data['parent'], self._tu, None)
-			else:
-				c = _cursor(child, data['parent'], self._tu, data['access_specifier'])
-			if c != Cursor.null():
-				data['children'].append(c)
-				if version <= 3.2 and c.kind == CursorKind.CXX_ACCESS_SPECIFIER:
-					# fix access_specifier on libclang <= 3.2 declarations ...
-					data['access_specifier'] = c.access_specifier
+			c = self._visit_child(child, state)
+			if c is not None:
+				children.append(c)
 			return 1 # continue
-		data = {'children': [], 'parent': self, 'access_specifier': None}
-		if version <= 3.2:
-			# fix access_specifier on libclang <= 3.2 declarations ...
-			if self.kind == CursorKind.STRUCT_DECL or self.kind == CursorKind.UNION_DECL:
-				data['access_specifier'] = AccessSpecifier.PUBLIC
-			elif self.kind == CursorKind.CLASS_DECL:
-				data['access_specifier'] = AccessSpecifier.PRIVATE
-		_libclang.clang_visitChildren(self._c, _map_type('cb_cursor_visitor')(visitor), data)
-		return data['children']
+		children = []
+		state = self._visit_state()
+		_libclang.clang_visitChildren(self._c, _map_type('cb_cursor_visitor')(visitor), None)
+		return children
+
+	@requires(2.7, 'clang_visitChildren', ['_CXCursor', 'cb_cursor_visitor', py_object], c_uint)
+	def walk(self, kinds=None, prune=None, main_file=False, system_headers=True, files=None):
+		""" A list of (cursor, depth) pairs for the cursors below this cursor in preorder. A cursor rejected by the main_file, system_headers or files filters is skipped along with its whole subtree. """
+
+		def materialize(frame):
+			# This uses an explicit stack as a RecursionError raised in the
+			# visitor callback is not propagated by ctypes, so deeply nested
+			# expressions would silently stop the traversal.
+			pending = []
+			while frame[1] is None and frame[3] is not None:
+				pending.append(frame)
+				frame = frame[3]
+			parent = frame[1]
+			while pending and parent is not None:
+				frame = pending.pop()
+				frame[1] = parent._visit_child(frame[0], frame[3][2])
+				if frame[1] is not None:
+					frame[2] = frame[1]._visit_state()
+				parent = frame[1]
+			return parent
+
+		def visitor(child, parent_cursor, args):
+			# ctypes does not propagate exceptions raised in the callback,
+			# so they are recorded and raised after the traversal stops.
+			try:
+				return visit(child, parent_cursor)
+			except Exception as e:
+				errors.append(e)
+				return 0 # break
+
+		def visit(child, parent_cursor):
+			parent_key = _cursor_key(parent_cursor)
+			while parent_key != stack[-1][4]:
+				stack.pop()
+				if not stack:
+					raise Exception('The parent of the visited cursor is not on the walk stack.')
+			if accept_location and not accept_location(child):
+				return 1 # continue
+			frame = [child, None, None, stack[-1], _cursor_key(child)]
+			if kinds is None or child.kind in kinds or child.kind in _fixup_kind_values or version <= 3.2:
+				# libclang <= 3.2 needs every cursor for the access_specifier fixes ...
+				c = materialize(frame)
+				if c is None:
+					return 1 # continue
+				if kinds is None or c.kind.value in kinds:
+					cursors.append((c, len(stack)))
+			if child.kind in prune:
+				return 1 # continue
+			stack.append(frame)
+			return 2 # recurse
+		if kinds is not None:
+			kinds = frozenset([k.value for k in kinds])
+		prune = frozenset([k.value for k in prune or []])
+		accept_location = _location_filter(self._tu, main_file, system_headers, files)
+		cursors = []
+		errors = []
+		stack = [[self._c, self, self._visit_state(), None, self._key]]
+		# The whole subtree is visited in a single clang_visitChildren call,
+		# so the cursors are collected into a list instead of being yielded
+		# as they are visited.
+		_libclang.clang_visitChildren(self._c, _map_type('cb_cursor_visitor')(visitor), None)
+		if errors:
+			raise errors[0]
+		return cursors
 
 	@property
 	@requires(2.7, 'clang_getCursorUSR', ['_CXCursor'], _CXString)
@@ -1740,6 +2588,8 @@ class Cursor:
 	@requires(2.7)
 	@optional(2.8, 'clang_getCXXAccessSpecifier', ['_CXCursor'], c_uint)
 	def access_specifier(self):
+		if self._fixups:
+			self._apply_fixups()
 		if self._access_specifier:
 			# overridden for compatibility/bug fixes ...
 			return self._access_specifier
@@ -1781,6 +2631,8 @@ class Cursor:
 	@requires(2.9, 'clang_getIncludedFile', ['_CXCursor'], c_void_p)
 	def included_file(self):
 		f = _libclang.clang_getIncludedFile(self._c)
+		if self._tu is not None and f:
+			return self._tu._file(f)
 		return File(f)
 
 	@property
@@ -1908,6 +2760,8 @@ class Cursor:
 		return bool(_libclang.clang_Cursor_isObjCOptional(self._c))
 
 class EnumDecl(Cursor):
+	__slots__ = ('_cached_enum_type',)
+
 	@requires(2.7)
 	def __init__(self, c, kind, parent, tu):
 		Cursor.__init__(self, c, kind, parent, tu)
@@ -1925,6 +2779,8 @@ class EnumDecl(Cursor):
 		return t.kind == TokenKind.KEYWORD and t.spelling == 'class'
 
 class EnumConstantDecl(Cursor):
+	__slots__ = ()
+
 	@requires(2.7)
 	def __init__(self, c, kind, parent, tu):
 		Cursor.__init__(self, c, kind, parent, tu)
@@ -1938,6 +2794,8 @@ class EnumConstantDecl(Cursor):
 		return _libclang.clang_getEnumConstantDeclValue(self._c)
 
 class CxxMethodDecl(Cursor):
+	__slots__ = ()
+
 	@requires(2.8)
 	def __init__(self, c, kind, parent, tu):
 		Cursor.__init__(self, c, kind, parent, tu)
@@ -1967,6 +2825,8 @@ class CxxMethodDecl(Cursor):
 		return bool(_libclang.clang_CXXMethod_isConst(self._c))
 
 class TypedefDecl(Cursor):
+	__slots__ = ('_cached_underlying_type',)
+
 	@requires(2.7)
 	def __init__(self, c, kind, parent, tu):
 		Cursor.__init__(self, c, kind, parent, tu)
@@ -1984,53 +2844,230 @@ _cursor_kinds = {
 	CursorKind.CXX_METHOD_DECL: CxxMethodDecl,
 }
 
-_cursor_cache = {}
+_own_access_specifier_kinds = frozenset([
+	CursorKind.CXX_ACCESS_SPECIFIER,
+	CursorKind.CXX_BASE_SPECIFIER])
+
+_template_parameter_kinds = frozenset([
+	CursorKind.TEMPLATE_TYPE_PARAMETER,
+	CursorKind.NON_TYPE_TEMPLATE_PARAMETER,
+	CursorKind.TEMPLATE_TEMPLATE_PARAMETER])
+
+_linkage_spec_pattern = TokenPattern((TokenKind.KEYWORD, 'extern'), TokenKind.LITERAL)
+
+_access_specifier_pattern = TokenPattern(TokenKind.KEYWORD, (TokenKind.PUNCTUATION, ':'))
+
+_access_specifier_keywords = {
+	'public': AccessSpecifier.PUBLIC,
+	'protected': AccessSpecifier.PROTECTED,
+	'private': AccessSpecifier.PRIVATE,
+}
+
+# Compatibility fixups are registered for the cursor kind and libclang
+# versions they apply to. When the library is loaded, the fixups for that
+# version are selected. They are then applied to a cursor the first time
+# its kind or access_specifier is read. Cursors with a fixup that can
+# change the kind are materialized by kind-filtered walks.
+
+_fixups = []
+_active_fixups = {}
+_fixup_kind_values = frozenset()
+
+def _fixup(kinds, min_version=None, max_version=None, changes_kind=True):
+	def register(f):
+		for kind in kinds:
+			_fixups.append((kind, min_version, max_version, changes_kind, f))
+		return f
+	return register
+
+def _select_fixups():
+	global _fixup_kind_values
+	_active_fixups.clear()
+	kind_values = set()
+	for kind, min_version, max_version, changes_kind, f in _fixups:
+		if min_version is not None and version < min_version:
+			continue
+		if max_version is not None and version > max_version:
+			continue
+		_active_fixups[kind] = _active_fixups.get(kind, ()) + (f,)
+		if changes_kind:
+			kind_values.add(kind.value)
+	_fixup_kind_values = frozenset(kind_values)
+
+@_fixup([CursorKind.UNEXPOSED_DECL])
+def _fixup_linkage_spec(cursor):
+	if _linkage_spec_pattern.match(cursor._tokens_left_of_children):
+		# libclang (all known versions) does not expose LINKAGE_SPEC ...
+		cursor._kind = CursorKind.LINKAGE_SPEC
+		return True
+	return False
+
+@_fixup([CursorKind.UNEXPOSED_DECL], max_version=2.9)
+def _fixup_access_specifier(cursor):
+	tokens = cursor._tokens_left_of_children
+	if not _access_specifier_pattern.match(tokens):
+		return False
+	# libclang <= 2.9 does not expose CXX_ACCESS_SPECIFIER ...
+	access_specifier = _access_specifier_keywords.get(tokens.spellings()[0])
+	if access_specifier is None:
+		return False
+	cursor._kind = CursorKind.CXX_ACCESS_SPECIFIER
+	cursor._access_specifier = access_specifier
+	return True
+
+@_fixup([CursorKind.UNEXPOSED_EXPR], max_version=2.9)
+def _fixup_nullptr_literal(cursor):
+	if cursor.type.kind == TypeKind.NULLPTR:
+		# libclang <= 2.9 does not expose CXX_NULLPTR_LITERAL_EXPR ...
+		cursor._kind = CursorKind.CXX_NULLPTR_LITERAL_EXPR
+		return True
+	return False
+
+@_fixup(_template_parameter_kinds, changes_kind=False)
+def _fixup_template_parameter(cursor):
+	# libclang >= 3.2 incorrectly assigns an access_specifier to these cursors ...
+	cursor._access_specifier = AccessSpecifier.INVALID
+	return True
+
+# The identity of a cursor, matching clang_equalCursors. This ignores
+# xdata. libclang >= 3.2 stores a "first in declaration group" flag in
+# data[1] of declarations that is only set on some of the cursors for the
+# same declaration, so clang_equalCursors ignores data[1] for those. Older
+# versions compare all of data. Checked against libclang 14, which is
+# detected as 3.5.
+def _cursor_key(c):
+	if version >= 3.2 and CursorKind(c.kind).is_declaration:
+		return (c.kind, c.data[0], None, c.data[2])
+	return (c.kind, c.data[0], c.data[1], c.data[2])
+
+_null_cursor_key = (70, None, None, None) # CursorKind.INVALID_FILE
+
+_null_cursor = None
 
 def _cursor(c, parent, tu, access_specifier=None):
-	try:
-		return _cursor_cache[c]
-	except:
-		pass
+	if tu is not None:
+		key = _cursor_key(c)
+		# The parent and access specifier depend on how the cursor was
+		# reached, so equal cursors with a different context are cached
+		# as different objects.
+		cache_key = (key, parent._key if parent is not None else None, access_specifier)
+		ret = tu.cursor_cache.get(cache_key)
+		if ret is not None:
+			return ret
 
 	kind = CursorKind(c.kind)
-	if kind == CursorKind.UNEXPOSED_DECL:
-		cursor = Cursor(c, kind, parent, tu)
-		tokens = cursor._tokens_left_of_children
-		if tokens.match(0, TokenKind.KEYWORD, 'extern') and tokens.match(1, TokenKind.LITERAL):
-			# libclang (all known versions) does not expose LINKAGE_SPEC ...
-			kind = CursorKind.LINKAGE_SPEC
-		elif tokens.match(0, TokenKind.KEYWORD) and tokens.match(1, TokenKind.PUNCTUATION, ':'):
-			keyword = tokens[0].spelling
-			# libclang <= 2.9 does not expose CXX_ACCESS_SPECIFIER ...
-			if keyword == 'public':
-				kind = CursorKind.CXX_ACCESS_SPECIFIER
-				access_specifier = AccessSpecifier.PUBLIC
-			elif keyword == 'protected':
-				kind = CursorKind.CXX_ACCESS_SPECIFIER
-				access_specifier = AccessSpecifier.PROTECTED
-			elif keyword == 'private':
-				kind = CursorKind.CXX_ACCESS_SPECIFIER
-				access_specifier = AccessSpecifier.PRIVATE
-	elif kind == CursorKind.UNEXPOSED_EXPR:
-		cursor = Cursor(c, kind, parent, tu)
-		if cursor.type.kind == TypeKind.NULLPTR:
-			# libclang <= 2.9 does not expose CXX_NULLPTR_LITERAL_EXPR ...
-			kind = CursorKind.CXX_NULLPTR_LITERAL_EXPR
-	if kind in [CursorKind.TEMPLATE_TYPE_PARAMETER,
-	            CursorKind.NON_TYPE_TEMPLATE_PARAMETER,
-	            CursorKind.TEMPLATE_TEMPLATE_PARAMETER]:
-		# libclang >= 3.2 incorrectly assigns an access_specifier to these cursors ...
-		access_specifier = AccessSpecifier.INVALID
 	try:
 		ret = _cursor_kinds[kind](c, kind, parent, tu)
 	except KeyError:
 		ret = Cursor(c, kind, parent, tu)
+	ret._fixups = _active_fixups.get(kind)
 	if access_specifier:
 		ret._access_specifier = access_specifier
-	_cursor_cache[c] = ret
+	if tu is not None:
+		ret._cached__key = key
+		tu.cursor_cache.add(cache_key, ret)
 	return ret
 
-class TranslationUnitFlags:
+def _file_pointer(f):
+	if isinstance(f, c_void_p):
+		return f.value
+	return f
+
+@requires(2.7, 'clang_getFile', [c_void_p, c_utf8_p], c_void_p)
+@requires(2.7, 'clang_getCursorLocation', ['_CXCursor'], _CXSourceLocation)
+@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+def _location_filter(tu, main_file, system_headers, files):
+	# This works on the raw _CXCursor structures so cursors that are
+	# filtered out do not need a Cursor object to be created.
+	if files is not None:
+		pointers = set()
+		for f in files:
+			if isinstance(f, File):
+				pointers.add(_file_pointer(f._f))
+			else:
+				pointers.add(_libclang.clang_getFile(tu._tu, f))
+		pointers.discard(None)
+	else:
+		pointers = None
+	if main_file and version < 3.4:
+		main_pointer = _libclang.clang_getFile(tu._tu, tu.spelling)
+	else:
+		main_pointer = None
+	if not main_file and system_headers and pointers is None:
+		return None
+	f = c_void_p()
+	def accept(c):
+		sl = _libclang.clang_getCursorLocation(c)
+		if pointers is not None or main_pointer is not None:
+			_libclang.clang_getInstantiationLocation(sl, byref(f), None, None, None)
+			if pointers is not None and f.value not in pointers:
+				return False
+			if main_pointer is not None and f.value != main_pointer:
+				return False
+		if main_file and main_pointer is None and not _libclang.clang_Location_isFromMainFile(sl):
+			return False
+		if not system_headers and _libclang.clang_Location_isInSystemHeader(sl):
+			return False
+		return True
+	return accept
+
+class LocationTable(object):
+	""" The file, line, column and offset of a sequence of source locations, as parallel arrays. """
+
+	def __init__(self):
+		self.files = []
+		self.file_ids = array('i')
+		self.lines = array('I')
+		self.columns = array('I')
+		self.offsets = array('I')
+
+	def __len__(self):
+		return len(self.file_ids)
+
+	def file(self, index):
+		file_id = self.file_ids[index]
+		if file_id == -1:
+			return None
+		return self.files[file_id]
+
+@requires(2.7, 'clang_getCursorLocation', ['_CXCursor'], _CXSourceLocation)
+@requires(2.7, 'clang_getTokenLocation', [c_void_p, _CXToken], _CXSourceLocation)
+@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+def decode_locations(items):
+	""" Decode the locations of cursors, tokens or source locations into a LocationTable. """
+	ret = LocationTable()
+	file_ids = {}
+	f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
+	for item in items:
+		if isinstance(item, Cursor):
+			sl = _libclang.clang_getCursorLocation(item._c)
+		elif isinstance(item, Token):
+			sl = _libclang.clang_getTokenLocation(item._tu._tu, item._t)
+		else:
+			sl = item._sl
+		_libclang.clang_getInstantiationLocation(sl, byref(f), byref(l), byref(c), byref(o))
+		if f.value:
+			try:
+				file_id = file_ids[f.value]
+			except KeyError:
+				file_id = len(ret.files)
+				file_ids[f.value] = file_id
+				tu = getattr(item, '_tu', None)
+				if tu is not None:
+					ret.files.append(tu._file(f.value))
+				else:
+					ret.files.append(File(f.value))
+		else:
+			file_id = -1
+		ret.file_ids.append(file_id)
+		ret.lines.append(l.value)
+		ret.columns.append(c.value)
+		ret.offsets.append(o.value)
+	return ret
+
+class TranslationUnitFlags(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -2064,9 +3101,9 @@ class TranslationUnitFlags:
 TranslationUnitFlags.NONE = TranslationUnitFlags(0) # 2.8
 TranslationUnitFlags.DETAILED_PREPROCESSING_RECORD = TranslationUnitFlags(1) # 2.8
 TranslationUnitFlags.INCOMPLETE = TranslationUnitFlags(2) # 2.8
-TranslationUnitFlags.PRECOMPILED_PREAMBLE = TranslationUnitFlags(4) # 2.8
 TranslationUnitFlags.CACHE_COMPLETION_RESULTS = TranslationUnitFlags(8) # 2.8
-TranslationUnitFlags.PRECOMPILED_PREAMBLE = TranslationUnitFlags(16) # 2.9 to 3.1
+TranslationUnitFlags.CXX_PRECOMPILED_PREAMBLE = TranslationUnitFlags(16) # 2.9 to 3.1
+TranslationUnitFlags.PRECOMPILED_PREAMBLE = TranslationUnitFlags.CXX_PRECOMPILED_PREAMBLE # 2.9 to 3.1
 TranslationUnitFlags.FOR_SERIALIZATION = TranslationUnitFlags(16) # 3.2
 TranslationUnitFlags.CHAINED_PCH = TranslationUnitFlags(32) # 2.9
 TranslationUnitFlags.NESTED_MACRO_EXPANSIONS = TranslationUnitFlags(64) # 3.0 only
@@ -2074,7 +3111,9 @@ TranslationUnitFlags.NESTED_MACRO_INSTANTIATIONS = TranslationUnitFlags.NESTED_M
 TranslationUnitFlags.SKIP_FUNCTION_BODIES = TranslationUnitFlags(64) # 3.1
 TranslationUnitFlags.INCLUDE_BRIEF_COMMENTS_IN_CODE_COMPLETION = TranslationUnitFlags(128) # 3.2
 
-class SaveTranslationUnitFlags:
+class SaveTranslationUnitFlags(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -2101,7 +3140,9 @@ class SaveTranslationUnitFlags:
 
 SaveTranslationUnitFlags.NONE = SaveTranslationUnitFlags(0) # 2.8
 
-class ReparseTranslationUnitFlags:
+class ReparseTranslationUnitFlags(object):
+	__slots__ = ('value',)
+
 	@requires(2.8)
 	def __init__(self, value):
 		self.value = value
@@ -2128,15 +3169,326 @@ class ReparseTranslationUnitFlags:
 
 ReparseTranslationUnitFlags.NONE = ReparseTranslationUnitFlags(0) # 2.8
 
+class TUResourceUsageKind(object):
+	__slots__ = ('value',)
+
+	@requires(3.0)
+	def __init__(self, value):
+		self.value = value
+
+	@requires(3.0)
+	def __eq__(self, other):
+		return self.value == other.value
+
+	@requires(3.0)
+	def __ne__(self, other):
+		return self.value != other.value
+
+	@requires(3.0)
+	def __str__(self):
+		return self.name
+
+	@requires(3.0)
+	def __hash__(self):
+		return hash(self.value)
+
+	@requires(3.0)
+	def __repr__(self):
+		return 'TUResourceUsageKind({0})'.format(self.value)
+
+	@property
+	@requires(3.0, 'clang_getTUResourceUsageName', [c_uint], c_utf8_p)
+	def name(self):
+		return _libclang.clang_getTUResourceUsageName(self.value)
+
+TUResourceUsageKind.AST = TUResourceUsageKind(1) # 3.0
+TUResourceUsageKind.IDENTIFIERS = TUResourceUsageKind(2) # 3.0
+TUResourceUsageKind.SELECTORS = TUResourceUsageKind(3) # 3.0
+TUResourceUsageKind.GLOBAL_COMPLETION_RESULTS = TUResourceUsageKind(4) # 3.0
+TUResourceUsageKind.SOURCE_MANAGER_CONTENT_CACHE = TUResourceUsageKind(5) # 3.0
+TUResourceUsageKind.AST_SIDE_TABLES = TUResourceUsageKind(6) # 3.0
+TUResourceUsageKind.SOURCE_MANAGER_MEMBUFFER_MALLOC = TUResourceUsageKind(7) # 3.0
+TUResourceUsageKind.SOURCE_MANAGER_MEMBUFFER_MMAP = TUResourceUsageKind(8) # 3.0
+TUResourceUsageKind.EXTERNAL_AST_SOURCE_MEMBUFFER_MALLOC = TUResourceUsageKind(9) # 3.0
+TUResourceUsageKind.EXTERNAL_AST_SOURCE_MEMBUFFER_MMAP = TUResourceUsageKind(10) # 3.0
+TUResourceUsageKind.PREPROCESSOR = TUResourceUsageKind(11) # 3.0
+TUResourceUsageKind.PREPROCESSING_RECORD = TUResourceUsageKind(12) # 3.0
+TUResourceUsageKind.SOURCE_MANAGER_DATA_STRUCTURES = TUResourceUsageKind(13) # 3.0
+TUResourceUsageKind.PREPROCESSOR_HEADER_SEARCH = TUResourceUsageKind(14) # 3.0
+
+class ASTSnapshot(object):
+	""" A flat, array-backed copy of the cursors in a translation unit. """
+
+	def __init__(self):
+		self.kinds = array('H')
+		self.parents = array('i')
+		self.first_children = array('i')
+		self.next_siblings = array('i')
+		self.subtree_ends = array('i')
+		self.depths = array('H')
+		self.files = array('i')
+		self.start_offsets = array('I')
+		self.end_offsets = array('I')
+		self.lines = array('I')
+		self.columns = array('I')
+		self.spellings = array('i')
+		self.usrs = array('i')
+		self.filenames = []
+		self.strings = []
+
+	def __len__(self):
+		return len(self.kinds)
+
+	@requires(2.7, 'clang_visitChildren', ['_CXCursor', 'cb_cursor_visitor', py_object], c_uint)
+	@requires(2.7, 'clang_equalCursors', ['_CXCursor', '_CXCursor'], c_uint)
+	@requires(2.7, 'clang_getCursorExtent', ['_CXCursor'], _CXSourceRange)
+	@requires(2.7, 'clang_getRangeStart', [_CXSourceRange], _CXSourceLocation)
+	@requires(2.7, 'clang_getRangeEnd', [_CXSourceRange], _CXSourceLocation)
+	@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+	@requires(2.7, 'clang_getFileName', [c_void_p], _CXString)
+	@requires(2.7, 'clang_getCursorSpelling', ['_CXCursor'], _CXString)
+	@requires(2.7, 'clang_getCursorUSR', ['_CXCursor'], _CXString)
+	def _build(self, root):
+		def string_id(s):
+			try:
+				return strings[s]
+			except KeyError:
+				strings[s] = len(self.strings)
+				self.strings.append(s)
+				return strings[s]
+
+		def file_id(f):
+			if not f:
+				return -1
+			try:
+				return files[f]
+			except KeyError:
+				files[f] = len(self.filenames)
+				self.filenames.append(_to_str(_libclang.clang_getFileName(f)))
+				return files[f]
+
+		def visitor(child, parent_cursor, args):
+			while not _libclang.clang_equalCursors(parent_cursor, stack[-1][0]):
+				self.subtree_ends[stack.pop()[1]] = len(self.kinds)
+			parent = stack[-1]
+			index = len(self.kinds)
+			if parent[2] != -1:
+				self.next_siblings[parent[2]] = index
+			elif parent[1] != -1:
+				self.first_children[parent[1]] = index
+			parent[2] = index
+			sr = _libclang.clang_getCursorExtent(child)
+			_libclang.clang_getInstantiationLocation(_libclang.clang_getRangeStart(sr), byref(f), byref(l), byref(c), byref(o))
+			self.kinds.append(child.kind)
+			self.parents.append(parent[1])
+			self.first_children.append(-1)
+			self.next_siblings.append(-1)
+			self.subtree_ends.append(index + 1)
+			self.depths.append(len(stack))
+			self.files.append(file_id(f.value))
+			self.start_offsets.append(o.value)
+			self.lines.append(l.value)
+			self.columns.append(c.value)
+			_libclang.clang_getInstantiationLocation(_libclang.clang_getRangeEnd(sr), None, None, None, byref(o))
+			self.end_offsets.append(o.value)
+			self.spellings.append(string_id(_to_str(_libclang.clang_getCursorSpelling(child)) or ''))
+			self.usrs.append(string_id(_to_str(_libclang.clang_getCursorUSR(child)) or ''))
+			stack.append([child, index, -1])
+			return 2 # recurse
+		strings = {}
+		files = {}
+		f, l, c, o = c_void_p(), c_uint(), c_uint(), c_uint()
+		stack = [[root, -1, -1]]
+		_libclang.clang_visitChildren(root, _map_type('cb_cursor_visitor')(visitor), None)
+		while len(stack) > 1:
+			self.subtree_ends[stack.pop()[1]] = len(self.kinds)
+
+	def kind(self, index):
+		return CursorKind(self.kinds[index])
+
+	def parent(self, index):
+		return self.parents[index]
+
+	def spelling(self, index):
+		return self.strings[self.spellings[index]]
+
+	def usr(self, index):
+		return self.strings[self.usrs[index]]
+
+	def filename(self, index):
+		f = self.files[index]
+		if f == -1:
+			return None
+		return self.filenames[f]
+
+	def children(self, index=-1):
+		if index == -1:
+			child = 0 if len(self) > 0 else -1
+		else:
+			child = self.first_children[index]
+		while child != -1:
+			yield child
+			child = self.next_siblings[child]
+
+	def descendants(self, index=-1):
+		if index == -1:
+			return range(0, len(self))
+		return range(index + 1, self.subtree_ends[index])
+
+	def find(self, kinds, index=-1):
+		values = set([k.value for k in kinds])
+		kinds = self.kinds
+		return [i for i in self.descendants(index) if kinds[i] in values]
+
+	def count_by_kind(self, index=-1):
+		counts = {}
+		kinds = self.kinds
+		for i in self.descendants(index):
+			counts[kinds[i]] = counts.get(kinds[i], 0) + 1
+		return dict([(CursorKind(k), n) for k, n in counts.items()])
+
+	def as_numpy(self, name):
+		import numpy
+		values = getattr(self, name)
+		return numpy.frombuffer(values, dtype=values.typecode)
+
+class CursorIndex(object):
+	""" An interval index of the cursor extents in a file, for finding the cursors at an offset or in a range. """
+
+	@requires(2.7, 'clang_getCursorExtent', ['_CXCursor'], _CXSourceRange)
+	@requires(2.7, 'clang_getRangeStart', [_CXSourceRange], _CXSourceLocation)
+	@requires(2.7, 'clang_getRangeEnd', [_CXSourceRange], _CXSourceLocation)
+	@requires(2.7, 'clang_getInstantiationLocation', [_CXSourceLocation, POINTER(c_void_p), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)])
+	def __init__(self, tu, f):
+		if not isinstance(f, File):
+			f = tu.file(f)
+		self.file = f
+		items = []
+		cf, o = c_void_p(), c_uint()
+		for cursor, depth in tu.walk(files=[f]):
+			sr = _libclang.clang_getCursorExtent(cursor._c)
+			_libclang.clang_getInstantiationLocation(_libclang.clang_getRangeStart(sr), byref(cf), None, None, byref(o))
+			if cf.value != f._f:
+				continue
+			start = o.value
+			_libclang.clang_getInstantiationLocation(_libclang.clang_getRangeEnd(sr), byref(cf), None, None, byref(o))
+			if cf.value != f._f or o.value < start:
+				continue
+			# Sorting on the walk order as well puts cursors with the same
+			# extent in parent to child order, so the innermost cursor of
+			# any set of matches is the one with the highest index.
+			items.append((start, -o.value, len(items), cursor))
+		items.sort()
+		self.cursors = [item[3] for item in items]
+		self.starts = array('I', [item[0] for item in items])
+		self.ends = array('I', [-item[1] for item in items])
+		# A segment tree of the maximum end offset, used to skip over
+		# the cursors that end before the query range.
+		size = 1
+		while size < len(items):
+			size = size * 2
+		self._size = size
+		tree = [0] * (2 * size)
+		tree[size:size + len(items)] = self.ends
+		for i in range(size - 1, 0, -1):
+			tree[i] = max(tree[2 * i], tree[2 * i + 1])
+		self._tree = tree
+
+	def __len__(self):
+		return len(self.cursors)
+
+	def _overlapping(self, start, end):
+		# Returns the indices of the cursors where cursor.start < end and
+		# cursor.end > start, or that contain start if the range is empty.
+		last = bisect_right(self.starts, start if start == end else end - 1)
+		ret = []
+		tree = self._tree
+		stack = [(1, 0, self._size)]
+		while stack:
+			node, lo, hi = stack.pop()
+			if lo >= last or tree[node] <= start:
+				continue
+			if node >= self._size:
+				ret.append(lo)
+				continue
+			mid = (lo + hi) // 2
+			stack.append((2 * node + 1, mid, hi))
+			stack.append((2 * node, lo, mid))
+		return ret
+
+	def at(self, offset):
+		""" The innermost cursor containing the offset. """
+		if isinstance(offset, SourceLocation):
+			offset = offset.offset
+		matches = self._overlapping(offset, offset + 1)
+		if not matches:
+			return None
+		return self.cursors[matches[-1]]
+
+	def overlapping(self, start, end=None):
+		""" The cursors overlapping the range, in start offset order. """
+		if isinstance(start, SourceRange):
+			start, end = start.start.offset, start.end.offset
+		elif end is None:
+			end = start + 1
+		return [self.cursors[i] for i in self._overlapping(start, end)]
+
+	def enclosing(self, start, kinds, end=None):
+		""" The innermost cursor of one of the kinds that contains the offset or range. """
+		if isinstance(start, SourceRange):
+			start, end = start.start.offset, start.end.offset
+		elif end is None:
+			end = start + 1
+		for i in reversed(self._overlapping(start, end)):
+			if self.starts[i] <= start and self.ends[i] >= end and self.cursors[i].kind in kinds:
+				return self.cursors[i]
+		return None
+
+_cb_inclusion_visitor = CFUNCTYPE(None, c_void_p, POINTER(_CXSourceLocation), c_uint, py_object)
+
 class TranslationUnit:
+	cursor_cache_size = 65536
+
 	@requires(2.7)
-	def __init__(self, tu, index):
+	def __init__(self, tu, index, unsaved_files=None):
 		self._tu = tu
 		self._index = index
+		self._unsaved_files = unsaved_files or {}
+		self._files = {}
+		self._file_names = {}
+		self.cursor_cache = LRUCache(TranslationUnit.cursor_cache_size)
+		# The number of distinct types is bounded by the translation unit,
+		# so this is a dict instead of an LRUCache to avoid the locking.
+		self.type_cache = {}
+		# The diagnostics of a translation unit loaded by ASTCache, as these
+		# are not saved in the AST file.
+		self._saved_diagnostics = None
 
-	@requires(2.7, 'clang_disposeTranslationUnit', [c_void_p])
+	@requires(2.7)
 	def __del__(self):
-		_libclang.clang_disposeTranslationUnit(self._tu)
+		self.dispose()
+
+	@requires(2.7)
+	def __enter__(self):
+		return self
+
+	@requires(2.7)
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.dispose()
+
+	@requires(2.7, 'clang_disposeTranslationUnit', [c_void_p])
+	def dispose(self):
+		""" Dispose the translation unit now instead of when it is garbage collected. The cursors, types and tokens from it must not be used afterwards. """
+		# The cached cursors and types refer back to the translation unit,
+		# so without this it is only released by the cyclic garbage
+		# collector.
+		self.cursor_cache.clear()
+		self.type_cache.clear()
+		self._file_names.clear()
+		self._files.clear()
+		if self._tu:
+			_libclang.clang_disposeTranslationUnit(self._tu)
+			self._tu = None
 
 	@requires(2.7)
 	def __str__(self):
@@ -2144,10 +3496,36 @@ class TranslationUnit:
 
 	@requires(2.7, 'clang_getFile', [c_void_p, c_utf8_p], c_void_p)
 	def file(self, filename):
+		try:
+			return self._file_names[filename]
+		except KeyError:
+			pass
 		ret = _libclang.clang_getFile(self._tu, filename)
 		if not ret:
 			raise Exception('File "%s" not in the translation unit.' % filename)
-		return File(ret)
+		ret = self._file(ret)
+		self._file_names[filename] = ret
+		return ret
+
+	@requires(2.7)
+	def _file(self, f):
+		# The CXFile pointers are only valid while the translation unit is
+		# alive, so the table is cleared when it is reparsed or disposed.
+		try:
+			return self._files[f]
+		except KeyError:
+			pass
+		ret = File(f)
+		if self._unsaved_files:
+			ret._contents = self._unsaved_files.get(ret.name)
+		return self._files.setdefault(f, ret)
+
+	@requires(2.7)
+	def line_table(self, f):
+		""" The LineTable of the file, using the contents of the unsaved file if there is one. """
+		if isinstance(f, File):
+			f = f.name
+		return self.file(f).line_table
 
 	@requires(2.9, 'clang_getLocationForOffset', [c_void_p, c_void_p, c_uint], _CXSourceLocation)
 	def _location_by_offset(self, cxfile, offset):
@@ -2164,7 +3542,7 @@ class TranslationUnit:
 			ret = self._location_by_offset(cxfile, offset)
 		if not ret:
 			raise Exception('Unable to determine the file location in this translation unit.')
-		return SourceLocation(ret)
+		return SourceLocation(ret, self)
 
 	@property
 	@requires(2.7, 'clang_getNumDiagnostics', [c_void_p], c_uint)
@@ -2174,6 +3552,25 @@ class TranslationUnit:
 			d = _libclang.clang_getDiagnostic(self._tu, i)
 			yield Diagnostic(d)
 
+	@requires(2.7, 'clang_getNumDiagnostics', [c_void_p], c_uint)
+	@requires(2.7, 'clang_getDiagnostic', [c_void_p, c_uint], c_void_p)
+	@requires(2.7, 'clang_getDiagnosticSeverity', [c_void_p], c_uint)
+	@requires(2.7, 'clang_disposeDiagnostic', [c_void_p])
+	def diagnostics_snapshot(self, min_severity=DiagnosticSeverity.NOTE):
+		""" A list of DiagnosticRecord for the diagnostics with at least the given severity. """
+		if self._saved_diagnostics is not None:
+			return [d for d in self._saved_diagnostics if d.severity.value >= min_severity.value]
+		ret = []
+		for i in range(0, _libclang.clang_getNumDiagnostics(self._tu)):
+			d = _libclang.clang_getDiagnostic(self._tu, i)
+			try:
+				severity = _libclang.clang_getDiagnosticSeverity(d)
+				if severity >= min_severity.value:
+					ret.append(_diagnostic_record(d, DiagnosticSeverity(severity)))
+			finally:
+				_libclang.clang_disposeDiagnostic(d)
+		return ret
+
 	@property
 	@requires(2.7, 'clang_getTranslationUnitSpelling', [c_void_p], _CXString)
 	def spelling(self):
@@ -2189,6 +3586,36 @@ class TranslationUnit:
 			c = _libclang.clang_getCursor(self._tu, source_location._sl)
 		return _cursor(c, None, self)
 
+	@requires(2.7)
+	def snapshot(self):
+		ret = ASTSnapshot()
+		ret._build(self.cursor()._c)
+		return ret
+
+	@requires(2.7)
+	def cursor_index(self, f):
+		return CursorIndex(self, f)
+
+	@requires(2.7)
+	def walk(self, kinds=None, prune=None, main_file=False, system_headers=True, files=None):
+		return self.cursor().walk(kinds=kinds, prune=prune, main_file=main_file, system_headers=system_headers, files=files)
+
+	@requires(3.3)
+	def record_layouts(self, main_file=False, system_headers=True, files=None):
+		""" Yield the RecordLayout of each struct, union and class defined in the translation unit. """
+		seen = set()
+		cursors = self.walk(kinds=_layout_kinds, main_file=main_file, system_headers=system_headers, files=files)
+		for record, fields in _record_fields(cursors):
+			if not record.is_definition:
+				continue
+			t = record.type.canonical_type
+			if t in seen:
+				continue
+			seen.add(t)
+			layout = t._layout(fields)
+			if layout is not None:
+				yield layout
+
 	@requires(2.7, 'clang_tokenize', [c_void_p, _CXSourceRange, POINTER(POINTER(_CXToken)), POINTER(c_uint)])
 	def tokenize(self, srcrange):
 		tokens = POINTER(_CXToken)()
@@ -2197,32 +3624,64 @@ class TranslationUnit:
 		length = int(length.value)
 		return TokenList(self, tokens, length)
 
-	@staticmethod
 	@requires(2.8, 'clang_defaultSaveOptions', [c_void_p], c_uint)
-	def DEFAULT_SAVE_OPTIONS():
+	def DEFAULT_SAVE_OPTIONS(self):
 		value = _libclang.clang_defaultSaveOptions(self._tu)
 		return SaveTranslationUnitFlags(value)
 
 	@requires(2.8, 'clang_saveTranslationUnit', [c_void_p, c_utf8_p, c_uint], c_int)
 	def save(self, filename, options=SaveTranslationUnitFlags.NONE):
-		return bool(_libclang.clang_saveTranslationUnit(self._tu, filename, options.value))
+		return _libclang.clang_saveTranslationUnit(self._tu, filename, options.value) == 0
 
-	@staticmethod
 	@requires(2.8, 'clang_defaultReparseOptions', [c_void_p], c_uint)
-	def DEFAULT_REPARSE_OPTIONS():
+	def DEFAULT_REPARSE_OPTIONS(self):
 		value = _libclang.clang_defaultReparseOptions(self._tu)
 		return ReparseTranslationUnitFlags(value)
 
 	@requires(2.8, 'clang_reparseTranslationUnit', [c_void_p, c_uint, POINTER(_CXUnsavedFile), c_uint], c_int)
-	def reparse(self, unsaved_files, options=ReparseTranslationUnitFlags.NONE):
+	def reparse(self, unsaved_files=None, options=ReparseTranslationUnitFlags.NONE):
 		unsavedc, unsavedv = _marshall_unsaved_files(unsaved_files)
-		return bool(_libclang.clang_saveTranslationUnit(self._tu, unsavedc, unsavedv, options.value))
+		self.cursor_cache.clear()
+		self.type_cache.clear()
+		self._saved_diagnostics = None
+		self._unsaved_files = unsavedv._contents if unsavedv else {}
+		self._file_names.clear()
+		self._files.clear()
+		return _libclang.clang_reparseTranslationUnit(self._tu, unsavedc, unsavedv, options.value) == 0
 
 	@requires(3.0, 'clang_isFileMultipleIncludeGuarded', [c_void_p, c_void_p], c_uint)
 	def is_multiple_include_guarded(self, srcfile):
 		return bool(_libclang.clang_isFileMultipleIncludeGuarded(self._tu, srcfile._f))
 
-class GlobalOptionFlags:
+	@property
+	@requires(3.0, 'clang_getCXTUResourceUsage', [c_void_p], _CXTUResourceUsage)
+	@requires(3.0, 'clang_disposeCXTUResourceUsage', [_CXTUResourceUsage])
+	def resource_usage(self):
+		usage = _libclang.clang_getCXTUResourceUsage(self._tu)
+		ret = OrderedDict()
+		for i in range(0, usage.numEntries):
+			entry = usage.entries[i]
+			ret[TUResourceUsageKind(entry.kind)] = entry.amount
+		_libclang.clang_disposeCXTUResourceUsage(usage)
+		return ret
+
+	@property
+	@requires(3.0)
+	def memory_usage(self):
+		return sum(self.resource_usage.values())
+
+	@property
+	@requires(2.7, 'clang_getInclusions', [c_void_p, _cb_inclusion_visitor, py_object])
+	def included_files(self):
+		ret = []
+		def visitor(f, stack, depth, data):
+			ret.append(self._file(f))
+		_libclang.clang_getInclusions(self._tu, _cb_inclusion_visitor(visitor), None)
+		return ret
+
+class GlobalOptionFlags(object):
+	__slots__ = ('value',)
+
 	@requires(3.1)
 	def __init__(self, value):
 		self.value = value
@@ -2264,6 +3723,8 @@ class Index:
 	@requires(2.7, 'clang_createTranslationUnit', [c_void_p, c_utf8_p], c_void_p)
 	def from_ast(self, filename):
 		tu = _libclang.clang_createTranslationUnit(self._index, filename)
+		if not tu:
+			return None
 		return TranslationUnit(tu, self)
 
 	@requires(2.7, 'clang_createTranslationUnitFromSourceFile', [c_void_p, c_utf8_p, c_int, POINTER(c_utf8_p), c_uint, POINTER(_CXUnsavedFile)], c_void_p)
@@ -2277,7 +3738,7 @@ class Index:
 			tu = _libclang.clang_createTranslationUnitFromSourceFile(self._index, filename, argc, argv, unsavedc, unsavedv)
 		if not tu:
 			return None
-		return TranslationUnit(tu, self)
+		return TranslationUnit(tu, self, unsavedv._contents if unsavedv else None)
 
 	@property
 	@requires(3.1, 'clang_CXIndex_getGlobalOptions', [c_void_p], c_uint)
@@ -2289,3 +3750,684 @@ class Index:
 	@requires(3.1, 'clang_CXIndex_setGlobalOptions', [c_void_p, c_uint])
 	def global_options(self, options):
 		_libclang.clang_CXIndex_setGlobalOptions(self._index, options.value)
+
+def _parse_worker(jobs, results, options):
+	index = Index()
+	while True:
+		job = jobs.get()
+		if job is None:
+			return
+		filename, args, unsaved_files = job
+		try:
+			start = time.time()
+			tu = index.parse(filename, args=args, unsaved_files=unsaved_files, options=options)
+			if tu is None:
+				results.put((filename, None, Exception('Unable to parse {0}.'.format(filename)), 0))
+				continue
+			results.put((filename, tu, None, time.time() - start))
+		except Exception as e:
+			results.put((filename, None, e, 0))
+
+ParseResult = namedtuple('ParseResult', ['filename', 'tu', 'error'])
+
+def parse_many(files, args=None, unsaved_files=None, options=TranslationUnitFlags.NONE, workers=None, costs=None):
+	""" Parse the files on a pool of threads, yielding a ParseResult for each file as it completes. """
+
+	# ctypes releases the GIL while libclang is parsing, so the parses
+	# run concurrently. Each thread uses its own Index.
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	elif workers < 1:
+		raise ValueError('parse_many needs at least one worker.')
+	jobs = queue.Queue()
+	results = queue.Queue()
+	threads = []
+	for i in range(0, workers):
+		thread = threading.Thread(target=_parse_worker, args=(jobs, results, options))
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	files = iter(files)
+	pending = 0
+	try:
+		while True:
+			while files and pending < 2 * workers:
+				try:
+					job = next(files)
+				except StopIteration:
+					files = None
+					break
+				if isinstance(job, tuple):
+					jobs.put((job[0], job[1], unsaved_files))
+				else:
+					jobs.put((job, args, unsaved_files))
+				pending = pending + 1
+			if pending == 0:
+				break
+			filename, tu, error, elapsed = results.get()
+			pending = pending - 1
+			if costs is not None and error is None:
+				costs[filename] = elapsed
+			yield ParseResult(filename, tu, error)
+	finally:
+		# Drop the jobs that have not started so that stopping early does
+		# not wait for them, then wait for the threads so they are not
+		# still running at interpreter shutdown.
+		try:
+			while True:
+				jobs.get_nowait()
+		except queue.Empty:
+			pass
+		for thread in threads:
+			jobs.put(None)
+		for thread in threads:
+			thread.join()
+
+IndexResult = namedtuple('IndexResult', ['filename', 'value', 'diagnostics', 'error'])
+
+def _index_worker(library, conn, func, options, min_severity):
+	load(library)
+	index = Index()
+	while True:
+		try:
+			job = conn.recv()
+		except EOFError:
+			return
+		if job is None:
+			return
+		filename, args = job
+		try:
+			tu = index.parse(filename, args=args, options=options)
+			if not tu:
+				conn.send(IndexResult(filename, None, [], 'Unable to parse the file.'))
+				continue
+			diagnostics = []
+			for d in tu.diagnostics:
+				if d.severity.value >= min_severity.value:
+					diagnostics.append(d.format())
+			value = func(tu)
+			tu = None
+			conn.send(IndexResult(filename, value, diagnostics, None))
+		except Exception:
+			conn.send(IndexResult(filename, None, [], traceback.format_exc()))
+
+def index_many(files, func, args=None, options=TranslationUnitFlags.NONE, workers=None, library=None, min_severity=DiagnosticSeverity.ERROR):
+	""" Run func over each parsed file on a pool of processes, yielding IndexResult values as they complete. """
+
+	# Each worker process handles one file at a time, so if libclang
+	# crashes the file being processed is known and only that file
+	# fails. The worker is then replaced by a new one. Each worker has its
+	# own pipe, so a worker that exits while sending a result does not
+	# affect the other workers.
+	#
+	# The worker processes import func from its module, so with the spawn
+	# start method that module must be importable without side effects.
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if library is None:
+		library = _library_name
+	pool = []
+
+	def start():
+		conn, child = multiprocessing.Pipe()
+		process = multiprocessing.Process(target=_index_worker, args=(library, child, func, options, min_severity))
+		process.daemon = True
+		process.start()
+		child.close()
+		return {'process': process, 'conn': conn, 'job': None}
+
+	def stop(worker):
+		worker['conn'].close()
+		worker['process'].join(1)
+		if worker['process'].is_alive():
+			worker['process'].terminate()
+
+	def send(i, job):
+		worker = pool[i]
+		if not worker['process'].is_alive():
+			# The worker exited while idle, so the job is given to a new
+			# worker instead of being reported as failed.
+			stop(worker)
+			worker = pool[i] = start()
+		worker['job'] = job
+		worker['conn'].send(job)
+
+	for worker in range(0, workers):
+		pool.append(start())
+	files = iter(files)
+	try:
+		while True:
+			for i, worker in enumerate(pool):
+				if files and worker['job'] is None:
+					try:
+						job = next(files)
+					except StopIteration:
+						files = None
+						break
+					if not isinstance(job, tuple):
+						job = (job, args)
+					send(i, job)
+			busy = [worker for worker in pool if worker['job'] is not None]
+			if not busy:
+				break
+			done = False
+			for i, worker in enumerate(pool):
+				if worker['job'] is None:
+					continue
+				try:
+					if not worker['conn'].poll():
+						if worker['process'].exitcode is None:
+							continue
+						raise EOFError()
+					result = worker['conn'].recv()
+				except (EOFError, IOError, OSError):
+					stop(worker)
+					error = 'Worker exited with code {0}.'.format(worker['process'].exitcode)
+					pool[i] = start()
+					done = True
+					yield IndexResult(worker['job'][0], None, [], error)
+					continue
+				worker['job'] = None
+				done = True
+				yield result
+			if not done:
+				busy[0]['conn'].poll(0.1)
+	finally:
+		for worker in pool:
+			try:
+				worker['conn'].send(None)
+			except (IOError, OSError):
+				pass
+		for worker in pool:
+			stop(worker)
+
+CompileCommand = namedtuple('CompileCommand', ['filename', 'args', 'directory'])
+
+if sys.version_info.major >= 3:
+	def _json_str(value):
+		return value
+else:
+	def _json_str(value):
+		return value.encode('utf-8')
+
+# The options that take a path, either as the next argument or joined to
+# the option. Relative paths are resolved against the command's directory.
+_path_options = ('-I', '-F', '-isystem', '-iquote', '-idirafter', '-iframework',
+                 '-include', '-imacros', '-isysroot', '--sysroot=', '--sysroot')
+
+# The options that write dependency files, and the ones of those that take
+# an argument. These are removed so parsing does not write .d files.
+_dependency_options = ('-M', '-MM', '-MD', '-MMD', '-MG', '-MP')
+_dependency_arg_options = ('-MF', '-MT', '-MQ', '-MJ')
+
+def _is_output_arg(arg):
+	# -objcmt-* and -object are options, not -o<path>.
+	return arg.startswith('-o') and not arg.startswith('-objc') and arg != '-object'
+
+def _compile_args(entry, directory):
+	if 'arguments' in entry:
+		argv = [_json_str(arg) for arg in entry['arguments']]
+	else:
+		argv = shlex.split(_json_str(entry['command']))
+	source = os.path.normpath(os.path.join(directory, _json_str(entry['file'])))
+	args = []
+	skip = False
+	path = False
+	for arg in argv[1:]:
+		if skip:
+			skip = False
+		elif path:
+			path = False
+			args.append(os.path.join(directory, arg))
+		elif arg == '-o' or arg in _dependency_arg_options:
+			skip = True
+		elif arg == '-c' or _is_output_arg(arg):
+			pass
+		elif arg in _dependency_options or arg[:3] in _dependency_arg_options:
+			pass
+		elif arg.startswith('-'):
+			for option in _path_options:
+				if arg == option:
+					path = True
+					args.append(arg)
+					break
+				if arg.startswith(option) and option != '--sysroot':
+					args.append(option + os.path.join(directory, arg[len(option):]))
+					break
+			else:
+				args.append(arg)
+		elif os.path.normpath(os.path.join(directory, arg)) != source:
+			args.append(arg)
+	return tuple(args)
+
+class CompilationDatabase(object):
+	""" A compile_commands.json file that is read incrementally. """
+
+	chunk_size = 65536
+
+	def __init__(self, filename, costs=None):
+		self.filename = filename
+		if costs is None:
+			costs = {}
+		self.costs = costs
+		self._args = {}
+
+	def _entries(self):
+		decoder = json.JSONDecoder()
+		with io.open(self.filename, encoding='utf-8') as f:
+			data = ''
+			pos = 0
+			eof = False
+			while True:
+				while pos < len(data) and data[pos] in ' \t\r\n,[]':
+					pos = pos + 1
+				if pos == len(data):
+					if eof:
+						return
+					data = f.read(self.chunk_size)
+					pos = 0
+					eof = not data
+					continue
+				try:
+					entry, end = decoder.raw_decode(data, pos)
+				except ValueError:
+					if eof:
+						raise
+					# The entry spans the end of the buffer, so read more data.
+					more = f.read(self.chunk_size)
+					data = data[pos:] + more
+					pos = 0
+					eof = not more
+					continue
+				pos = end
+				yield entry
+
+	def __iter__(self):
+		# Entries with the same file and arguments (e.g. from different
+		# build targets) are only parsed once. The argument tuples are
+		# shared between the commands that have the same arguments.
+		seen = set()
+		for entry in self._entries():
+			directory = _json_str(entry.get('directory', ''))
+			filename = os.path.join(directory, _json_str(entry['file']))
+			args = _compile_args(entry, directory)
+			args = self._args.setdefault(args, args)
+			key = (os.path.normpath(filename), args)
+			if key in seen:
+				continue
+			seen.add(key)
+			yield CompileCommand(filename, args, directory)
+
+	def jobs(self, window=4096):
+		""" Yield the commands, ordered by descending historical parse cost within each window of commands. """
+
+		# Unknown files are treated as the most expensive so that new
+		# files are started early and are given a cost for next time.
+		def cost(command):
+			return -self.costs.get(command.filename, float('inf'))
+
+		commands = []
+		for command in self:
+			commands.append(command)
+			if len(commands) == window:
+				for c in sorted(commands, key=cost):
+					yield c
+				commands = []
+		for c in sorted(commands, key=cost):
+			yield c
+
+	def parse(self, options=TranslationUnitFlags.NONE, workers=None, window=4096):
+		""" Parse the commands on a pool of threads, yielding a ParseResult for each command as it completes. """
+
+		# The relative paths in the arguments have already been resolved.
+		# This does not use -working-directory, as libclang implements that
+		# by changing the working directory of the whole process.
+		files = ((command.filename, command.args) for command in self.jobs(window))
+		return parse_many(files, options=options, workers=workers, costs=self.costs)
+
+	def load_costs(self, filename):
+		with io.open(filename, encoding='utf-8') as f:
+			self.costs.update(json.load(f))
+
+	def save_costs(self, filename):
+		with open(filename, 'w') as f:
+			json.dump(self.costs, f)
+
+def _read_unsaved_files(unsaved_files):
+	# File objects can only be read once, so they are read here to allow
+	# the contents to be both hashed and passed to libclang.
+	ret = []
+	for name, contents in unsaved_files or []:
+		if hasattr(contents, 'read') and not isinstance(contents, mmap.mmap):
+			contents = contents.read()
+		if not isinstance(contents, (bytes, bytearray, memoryview, mmap.mmap)):
+			contents = contents.encode('utf-8')
+		elif isinstance(contents, memoryview):
+			contents = contents.tobytes()
+		ret.append((name, contents))
+	return ret
+
+def _unsaved_files_digest(unsaved_files):
+	digest = hashlib.sha1()
+	for name, contents in unsaved_files:
+		digest.update(name.encode('utf-8'))
+		digest.update(b'\0')
+		digest.update(contents)
+		digest.update(b'\0')
+	return digest.hexdigest()
+
+def _diagnostic_record_to_json(d):
+	return [d.severity.value, d.filename, d.line, d.column, d.spelling, d.option, d.category, d.ranges, d.fixits]
+
+def _diagnostic_record_from_json(d):
+	severity, filename, line, column, spelling, option, category, ranges, fixits = d
+	def location_range(r):
+		return (tuple(r[0]), tuple(r[1]))
+	if filename is not None:
+		filename = _json_str(filename)
+	return DiagnosticRecord(DiagnosticSeverity(severity), filename, line, column, _json_str(spelling),
+	                        option and _json_str(option), category and _json_str(category),
+	                        [location_range(r) for r in ranges],
+	                        [(location_range(r), _json_str(text)) for r, text in fixits])
+
+class ASTCache(object):
+	""" A directory of saved translation units that is used to avoid reparsing unchanged files. """
+
+	def __init__(self, directory, max_size=1 << 30):
+		self.directory = directory
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	def _key(self, filename, args, options, unsaved_files):
+		key = hashlib.sha1()
+		key.update('{0}\0{1}\0{2}\0{3}\0'.format(version, os.getcwd(), filename, options.value).encode('utf-8'))
+		for arg in args or []:
+			key.update(arg.encode('utf-8'))
+			key.update(b'\0')
+		key.update(_unsaved_files_digest(unsaved_files).encode('utf-8'))
+		if filename not in [name for name, contents in unsaved_files]:
+			with open(filename, 'rb') as f:
+				key.update(f.read())
+		return os.path.join(self.directory, key.hexdigest())
+
+	def _read_manifest(self, path):
+		# The manifest records the size and modification time of every
+		# file included by the translation unit when it was saved, and
+		# the diagnostics from parsing it.
+		try:
+			with open(path + '.json') as f:
+				manifest = json.load(f)
+			for filename, mtime, size in manifest['files']:
+				st = os.stat(filename)
+				if st.st_mtime != mtime or st.st_size != size:
+					return None
+		except (IOError, OSError, ValueError, KeyError):
+			return None
+		if not os.path.exists(path + '.ast'):
+			return None
+		return manifest
+
+	def parse(self, index, filename, args=None, options=TranslationUnitFlags.NONE, unsaved_files=None):
+		""" Parse the file, or load it from the cache. The diagnostics of a loaded file are available from diagnostics_snapshot(). """
+		unsaved = _read_unsaved_files(unsaved_files)
+		path = self._key(filename, args, options, unsaved)
+		manifest = self._read_manifest(path)
+		if manifest is not None:
+			tu = index.from_ast(path + '.ast')
+			if tu:
+				self.hits = self.hits + 1
+				os.utime(path + '.ast', None)
+				tu._saved_diagnostics = [_diagnostic_record_from_json(d) for d in manifest['diagnostics']]
+				tu._unsaved_files = dict(unsaved)
+				return tu
+		self.misses = self.misses + 1
+		tu = index.parse(filename, args=args, options=options, unsaved_files=unsaved)
+		if not tu:
+			return None
+		# Translation units that have errors cannot be saved.
+		diagnostics = tu.diagnostics_snapshot()
+		for d in diagnostics:
+			if d.severity.value >= DiagnosticSeverity.ERROR.value:
+				return tu
+		if tu.save(path + '.ast'):
+			files = []
+			unsaved_names = set([name for name, contents in unsaved])
+			try:
+				for f in tu.included_files:
+					if f.name in unsaved_names:
+						continue # the contents are part of the key
+					st = os.stat(f.name)
+					files.append((f.name, st.st_mtime, st.st_size))
+			except OSError:
+				os.remove(path + '.ast')
+				return tu
+			manifest = {
+				'files': files,
+				'diagnostics': [_diagnostic_record_to_json(d) for d in diagnostics],
+			}
+			with open(path + '.json', 'w') as f:
+				json.dump(manifest, f)
+			self.evict()
+		return tu
+
+	@property
+	def size(self):
+		""" The total size of the saved translation units, which is what max_size limits. """
+		ret = 0
+		for name in os.listdir(self.directory):
+			if name.endswith('.ast'):
+				ret = ret + os.path.getsize(os.path.join(self.directory, name))
+		return ret
+
+	def evict(self):
+		entries = []
+		total = 0
+		for name in os.listdir(self.directory):
+			if name.endswith('.ast'):
+				path = os.path.join(self.directory, name[:-4])
+				st = os.stat(path + '.ast')
+				entries.append((st.st_mtime, st.st_size, path))
+				total = total + st.st_size
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.max_size:
+				break
+			for ext in ('.ast', '.json'):
+				if os.path.exists(path + ext):
+					os.remove(path + ext)
+			total = total - size
+			self.evictions = self.evictions + 1
+
+	def clear(self):
+		for name in os.listdir(self.directory):
+			if name.endswith('.ast') or name.endswith('.json'):
+				os.remove(os.path.join(self.directory, name))
+
+class TranslationUnitPool(object):
+	""" Parsed translation units keyed by file and arguments, disposing the least recently used when over max_bytes. """
+
+	# The translation units are disposed when they are evicted or removed,
+	# so they (and their cursors, types and tokens) must not be kept
+	# across calls to the pool. Use get() again to access a file.
+
+	def __init__(self, max_bytes, index=None, options=TranslationUnitFlags.NONE):
+		if index is None:
+			index = Index()
+		self.index = index
+		self.options = options
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		filename, args = key
+		return (filename, tuple(args or ())) in self._items
+
+	@property
+	def memory_usage(self):
+		with self._lock:
+			return sum([item[1] for item in self._items.values()])
+
+	def get(self, filename, args=None, unsaved_files=None):
+		""" The translation unit for the file and arguments, parsing it if needed. If unsaved_files differ from the cached unit, it is reparsed. """
+		key = (filename, tuple(args or ()))
+		unsaved_files = _read_unsaved_files(unsaved_files) if unsaved_files is not None else None
+		with self._lock:
+			item = self._items.pop(key, None)
+			if item:
+				self.hits = self.hits + 1
+				tu, size, digest = item
+				if unsaved_files is None or _unsaved_files_digest(unsaved_files) == digest:
+					# The memory usage changes as the unit is used, so it
+					# is sampled again on each access.
+					self._items[key] = (tu, tu.memory_usage, digest)
+					self._evict()
+					return tu
+				self._items[key] = item
+			else:
+				self.misses = self.misses + 1
+		if item:
+			return self.reparse(filename, args, unsaved_files)
+		# The parse is done without holding the lock, so other files can
+		# be parsed at the same time.
+		tu = self.index.parse(filename, args=args, unsaved_files=unsaved_files, options=self.options)
+		if tu is None:
+			return None
+		self._add(key, tu, unsaved_files)
+		return tu
+
+	def reparse(self, filename, args=None, unsaved_files=None):
+		key = (filename, tuple(args or ()))
+		unsaved_files = _read_unsaved_files(unsaved_files)
+		with self._lock:
+			item = self._items.pop(key, None)
+		if not item:
+			return None
+		tu = item[0]
+		if not tu.reparse(unsaved_files):
+			# The translation unit is invalid after a failed reparse.
+			return None
+		self._add(key, tu, unsaved_files)
+		return tu
+
+	def _add(self, key, tu, unsaved_files):
+		digest = _unsaved_files_digest(unsaved_files or [])
+		size = tu.memory_usage
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = (tu, size, digest)
+			self._evict()
+
+	def _evict(self):
+		# The most recently used translation unit is kept even if it is
+		# larger than max_bytes on its own.
+		total = sum([item[1] for item in self._items.values()])
+		while total > self.max_bytes and len(self._items) > 1:
+			key, (tu, size, digest) = self._items.popitem(last=False)
+			tu.dispose()
+			total = total - size
+			self.evictions = self.evictions + 1
+
+	def remove(self, filename, args=None):
+		""" Remove the translation unit for the file and arguments from the pool, and dispose it. """
+		with self._lock:
+			item = self._items.pop((filename, tuple(args or ())), None)
+			if item:
+				item[0].dispose()
+
+	def dispose(self):
+		""" Remove all the translation units from the pool, and dispose them. """
+		with self._lock:
+			for tu, size, digest in self._items.values():
+				tu.dispose()
+			self._items.clear()
+
+# CXTranslationUnit_PrecompiledPreamble. This is not exposed as a flag as
+# TranslationUnitFlags.PRECOMPILED_PREAMBLE has always had the value of
+# CXX_PRECOMPILED_PREAMBLE. It is part of the DEFAULT_EDITING() options.
+_precompiled_preamble = 4
+
+class EditSession(object):
+	""" A translation unit that is kept alive and reparsed from in-memory buffers as they are edited. """
+
+	def __init__(self, filename, contents=None, args=None, index=None, options=None):
+		if index is None:
+			index = Index()
+		if options is None:
+			options = TranslationUnitFlags.DEFAULT_EDITING()
+		self.filename = filename
+		self.args = args
+		self.index = index
+		self.options = options
+		self.tu = None
+		self.latencies = []
+		self.buffers = OrderedDict()
+		self.line_tables = {}
+		self.open(filename, contents)
+
+	def open(self, filename, contents=None):
+		if contents is None:
+			with open(filename, 'rb') as f:
+				contents = f.read()
+		elif not isinstance(contents, (bytes, bytearray)):
+			contents = contents.encode('utf-8')
+		self.buffers[filename] = bytearray(contents)
+		self.line_tables.pop(filename, None)
+
+	def offset(self, filename, line, column):
+		table = self.line_tables.get(filename)
+		if table is None:
+			table = LineTable(self.buffers[filename])
+			self.line_tables[filename] = table
+		return table.offset(line, column)
+
+	def edit(self, filename, start, end, text):
+		""" Replace the text between the start and end offsets, or (line, column) pairs, of the file. """
+		if isinstance(start, tuple):
+			start = self.offset(filename, *start)
+		if isinstance(end, tuple):
+			end = self.offset(filename, *end)
+		if not isinstance(text, (bytes, bytearray)):
+			text = text.encode('utf-8')
+		self.buffers[filename][start:end] = text
+		self.line_tables.pop(filename, None)
+
+	def contents(self, filename):
+		return bytes(self.buffers[filename])
+
+	@property
+	def latency(self):
+		if not self.latencies:
+			return None
+		return self.latencies[-1]
+
+	def reparse(self):
+		unsaved_files = list(self.buffers.items())
+		start = time.time()
+		if self.tu is None:
+			self.tu = self.index.parse(self.filename, args=self.args, unsaved_files=unsaved_files, options=self.options)
+			if self.tu is None:
+				raise Exception('Unable to parse {0}.'.format(self.filename))
+			# libclang builds the precompiled preamble on the first reparse,
+			# so do that now to make the reparse after the first edit fast.
+			if self.options.value & _precompiled_preamble:
+				self.tu.reparse(unsaved_files, self.tu.DEFAULT_REPARSE_OPTIONS())
+		elif not self.tu.reparse(unsaved_files, self.tu.DEFAULT_REPARSE_OPTIONS()):
+			# The translation unit is invalid after a failed reparse.
+			self.tu = None
+			raise Exception('Unable to reparse {0}.'.format(self.filename))
+		self.latencies.append(time.time() - start)
+		return self.tu
+
+	def dispose(self):
+		self.tu = None
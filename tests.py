@@ -17,10 +17,17 @@
 # You should have received a copy of the GNU General Public License
 # along with libclangpy.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import json
+import mmap
+import multiprocessing
+import os
 import sys
+import tempfile
 import traceback
 
 import libclang
+import testworkers
 
 class UnsupportedException(Exception):
 	pass
@@ -136,6 +143,8 @@ def test_File(f, filename):
 	equals(f != f, False)
 	equals(f == filename, True)
 	equals(f != filename, False)
+	equals(f == None, False)
+	equals(hash(f), hash(filename))
 
 def test_SourceLocation():
 	loc = libclang.SourceLocation.null()
@@ -241,6 +250,7 @@ def test_TokenKind():
 	equals(hash(a) == hash(a), True)
 	equals(hash(a) == hash(b), False)
 	equals(repr(a), 'TokenKind(1)')
+	equals(libclang.TokenKind(1) is a, True)
 
 def test_CursorKind():
 	equals(libclang.CursorKind.CLASS_DECL == libclang.CursorKind.CLASS_DECL, True)
@@ -261,6 +271,7 @@ def test_CursorKind():
 	equals(hash(a) == hash(a), True)
 	equals(hash(a) == hash(b), False)
 	equals(repr(a), 'CursorKind(9|VarDecl)')
+	equals(libclang.CursorKind(9) is a, True)
 
 def test_CursorKind28():
 	kind = libclang.CursorKind.STRUCT_DECL
@@ -284,6 +295,7 @@ def test_TypeKind28():
 	equals(hash(a) == hash(a), True)
 	equals(hash(a) == hash(b), False)
 	equals(repr(a), 'TypeKind(18|Long)')
+	equals(libclang.TypeKind(18) is a, True)
 
 def test_AvailabilityKind28():
 	a = libclang.AvailabilityKind.DEPRECATED
@@ -334,6 +346,20 @@ def test_NameRefFlags30():
 	equals(hash(a) == hash(b), False)
 	equals(repr(a), 'NameRefFlags(1)')
 
+def test_TUResourceUsageKind30():
+	a = libclang.TUResourceUsageKind.AST
+	b = libclang.TUResourceUsageKind.IDENTIFIERS
+	equals(a == a, True)
+	equals(a == b, False)
+	equals(a != a, False)
+	equals(a != b, True)
+	equals(a.value, 1)
+	equals(a.name, 'ASTContext: expressions, declarations, and types')
+	equals(str(b), 'ASTContext: identifiers')
+	equals(hash(a) == hash(a), True)
+	equals(hash(a) == hash(b), False)
+	equals(repr(a), 'TUResourceUsageKind(1)')
+
 def test_TranslationUnitFlags28():
 	a = libclang.TranslationUnitFlags.INCOMPLETE
 	b = libclang.TranslationUnitFlags.CACHE_COMPLETION_RESULTS
@@ -346,6 +372,7 @@ def test_TranslationUnitFlags28():
 	equals(hash(a) == hash(a), True)
 	equals(hash(a) == hash(b), False)
 	equals(repr(a), 'TranslationUnitFlags(2)')
+	equals(libclang.TranslationUnitFlags.PRECOMPILED_PREAMBLE.value, 16)
 
 def test_SaveTranslationUnitFlags28():
 	a = libclang.SaveTranslationUnitFlags(2)
@@ -463,6 +490,15 @@ def test_Index():
 	tu = index.parse('unsaved.cpp', unsaved_files=[('unsaved.cpp', 'struct test {};')])
 	equals(tu.spelling, 'unsaved.cpp')
 	equals(len(list(tu.diagnostics)), 0)
+	# unsaved files -- buffers
+	contents = 'struct test {};'.encode('utf-8')
+	m = mmap.mmap(-1, len(contents))
+	m.write(contents)
+	for buffer in [contents, bytearray(contents), memoryview(contents), memoryview(bytearray(contents)), m]:
+		tu = index.parse('unsaved.cpp', unsaved_files=[('unsaved.cpp', buffer)])
+		equals([c.spelling for c in tu.cursor().children], ['test'])
+		equals(len(list(tu.diagnostics)), 0)
+	m.close()
 
 def test_Index31():
 	index = libclang.Index()
@@ -484,6 +520,58 @@ def test_TranslationUnit():
 	match_location(tu.location(tu.spelling, 3, 2), filename, 3, 2, 13)
 	match_location(tu.location(tu.spelling, line=3, column=2), filename, 3, 2, 13)
 	equals(list(tu.diagnostics), [])
+	# cursor cache
+	equals(tu.cursor() is tu.cursor(), True)
+	equals(tu.cursor_cache.hits > 0, True)
+	tu.cursor_cache.max_size = 1
+	children = tu.cursor().children
+	equals(len(tu.cursor_cache), 1)
+	equals(tu.cursor_cache.evictions > 0, True)
+	# cursor cache -- the parent depends on how the cursor was reached
+	tu = index.parse('tests/parent.cpp', unsaved_files=[('tests/parent.cpp', 'struct s { int a; }; int f(struct s x) { return x.a; }')])
+	s, f = tu.cursor().children
+	m = [c for c, depth in f.walk() if c.kind == libclang.CursorKind.MEMBER_REF_EXPR][0]
+	equals(m.referenced.parent, None)
+	equals(s.children[0].parent, s)
+	equals(s.children[0] == m.referenced, True)
+	# dispose
+	with index.parse(filename) as tu:
+		children = tu.cursor().children
+		equals(len(tu.cursor_cache) > 0, True)
+	equals(len(tu.cursor_cache), 0)
+	equals(tu.cursor().is_null, True)
+	tu.dispose()
+
+def test_TranslationUnit28():
+	index = libclang.Index()
+	tu = index.parse('tests/enumeration.hpp')
+	equals(tu.DEFAULT_SAVE_OPTIONS(), libclang.SaveTranslationUnitFlags.NONE)
+	equals(tu.DEFAULT_REPARSE_OPTIONS(), libclang.ReparseTranslationUnitFlags.NONE)
+
+def test_EditSession28():
+	session = libclang.EditSession('tests/edit.cpp', 'struct a {};\nstruct b {};\n')
+	tu = session.reparse()
+	equals([c.spelling for c in tu.cursor().children], ['a', 'b'])
+	equals(len(session.latencies), 1)
+	session.edit('tests/edit.cpp', 7, 8, 'x')
+	session.edit('tests/edit.cpp', (2, 8), (2, 9), u'yz')
+	equals(session.contents('tests/edit.cpp'), b'struct x {};\nstruct yz {};\n')
+	equals(session.offset('tests/edit.cpp', 2, 1), 13)
+	try:
+		session.offset('tests/edit.cpp', 2, 20)
+		equals('ValueError', None)
+	except ValueError:
+		pass
+	equals(session.reparse() is tu, True)
+	equals([c.spelling for c in tu.cursor().children], ['x', 'yz'])
+	equals(len(session.latencies), 2)
+	equals(session.latency, session.latencies[-1])
+	session.open('tests/edit.hpp', 'struct c {};')
+	session.edit('tests/edit.cpp', 0, 0, '#include "edit.hpp"\n')
+	session.reparse()
+	equals([c.spelling for c in tu.cursor().children], ['c', 'x', 'yz'])
+	session.dispose()
+	equals(session.tu, None)
 
 def test_TranslationUnit29():
 	index = libclang.Index()
@@ -496,6 +584,341 @@ def test_TranslationUnit30():
 	filename = 'tests/enumeration.hpp'
 	tu = index.parse(filename)
 	equals(tu.is_multiple_include_guarded(tu.file(filename)), False)
+	usage = tu.resource_usage
+	equals(usage[libclang.TUResourceUsageKind.AST] > 0, True)
+	equals(tu.memory_usage, sum(usage.values()))
+	equals(tu.reparse(), True)
+
+def test_TranslationUnitPool30():
+	pool = libclang.TranslationUnitPool(1 << 40)
+	a = pool.get('tests/enumeration.hpp')
+	equals(pool.get('tests/enumeration.hpp') is a, True)
+	equals(('tests/enumeration.hpp', None) in pool, True)
+	b = pool.get('tests/enumeration.hpp', ['-std=c++98'])
+	equals(b is a, False)
+	equals((pool.hits, pool.misses, len(pool)), (1, 2, 2))
+	equals(pool.memory_usage, a.memory_usage + b.memory_usage)
+	c = pool.reparse('unsaved.hpp', unsaved_files=[('unsaved.hpp', 'struct b {};')])
+	equals(c, None)
+	c = pool.get('unsaved.hpp', unsaved_files=[('unsaved.hpp', 'struct a {};')])
+	equals([x.spelling for x in c.cursor().children], ['a'])
+	c = pool.reparse('unsaved.hpp', unsaved_files=[('unsaved.hpp', 'struct b {};')])
+	equals([x.spelling for x in c.cursor().children], ['b'])
+	pool.max_bytes = 0
+	pool.get('tests/enumeration.hpp')
+	equals((pool.evictions, len(pool)), (2, 1))
+	equals(('tests/enumeration.hpp', ['-std=c++98']) in pool, False)
+	pool.dispose()
+	equals(len(pool), 0)
+	# unsaved files on a hit
+	c = pool.get('unsaved.hpp', unsaved_files=[('unsaved.hpp', 'struct a {};')])
+	equals(pool.get('unsaved.hpp', unsaved_files=[('unsaved.hpp', b'struct a {};')]) is c, True)
+	equals([x.spelling for x in c.cursor().children], ['a'])
+	c = pool.get('unsaved.hpp', unsaved_files=[('unsaved.hpp', 'struct b {};')])
+	equals([x.spelling for x in c.cursor().children], ['b'])
+	# evicted translation units are disposed
+	pool = libclang.TranslationUnitPool(1)
+	a = pool.get('tests/enumeration.hpp')
+	equals(len(a.cursor().children), 1)
+	pool.get('tests/error.hpp')
+	equals(pool.evictions, 1)
+	equals(a.cursor().is_null, True)
+	a = pool.get('tests/enumeration.hpp')
+	equals(len(a.cursor().children), 1)
+	pool.remove('tests/enumeration.hpp')
+	equals(a.cursor().is_null, True)
+	equals(len(pool), 0)
+	# the memory usage is sampled on each access
+	pool = libclang.TranslationUnitPool(1 << 40)
+	a = pool.get('tests/enumeration.hpp')
+	pool.get('tests/enumeration.hpp')
+	equals(pool.memory_usage, a.memory_usage)
+	pool.dispose()
+	equals(a.cursor().is_null, True)
+
+def test_ASTSnapshot():
+	index = libclang.Index()
+	tu = index.parse('snapshot.cpp', unsaved_files=[('snapshot.cpp', 'struct x { int a; int b; };\nenum e { c };')])
+	snapshot = tu.snapshot()
+	del tu
+	equals(len(snapshot), 5)
+	equals([snapshot.spelling(i) for i in range(0, len(snapshot))], ['x', 'a', 'b', 'e', 'c'])
+	equals(snapshot.kind(0), libclang.CursorKind.STRUCT_DECL)
+	equals(list(snapshot.children()), [0, 3])
+	equals(list(snapshot.children(0)), [1, 2])
+	equals(list(snapshot.descendants(0)), [1, 2])
+	equals([snapshot.parent(i) for i in range(0, len(snapshot))], [-1, 0, 0, -1, 3])
+	equals(list(snapshot.depths), [1, 2, 2, 1, 2])
+	equals(snapshot.find([libclang.CursorKind.FIELD_DECL]), [1, 2])
+	equals(snapshot.find([libclang.CursorKind.FIELD_DECL], 3), [])
+	equals(snapshot.count_by_kind()[libclang.CursorKind.FIELD_DECL], 2)
+	equals(snapshot.filename(3), 'snapshot.cpp')
+	equals(snapshot.usr(0), 'c:@S@x')
+	equals(list(snapshot.lines), [1, 1, 1, 2, 2])
+	equals(list(snapshot.start_offsets), [0, 11, 18, 28, 37])
+	equals(list(snapshot.end_offsets), [26, 16, 23, 40, 38])
+
+def test_decode_locations():
+	index = libclang.Index()
+	tu = index.parse('locations.cpp', unsaved_files=[('locations.cpp', '#include "tests/enumeration.hpp"\nint x;\n')])
+	f = tu.file('tests/enumeration.hpp')
+	equals(f is tu.file('tests/enumeration.hpp'), True)
+	cursors = [c for c, depth in tu.walk()]
+	table = libclang.decode_locations(cursors)
+	equals(len(table), len(cursors))
+	equals(len(table.files), 2)
+	equals(table.file(0) is f, True)
+	equals(table.file(0) is cursors[0].location.file, True)
+	equals(table.file(len(table) - 1).name, 'locations.cpp')
+	equals(list(table.lines), [c.location.line for c in cursors])
+	equals(list(table.columns), [c.location.column for c in cursors])
+	equals(list(table.offsets), [c.location.offset for c in cursors])
+	tokens = tu.tokenize(cursors[-1].extent)
+	table = libclang.decode_locations(list(tokens) + [libclang.SourceLocation.null()])
+	equals(list(table.file_ids), [0, 0, -1])
+	equals(list(table.columns), [1, 5, 0])
+	equals(table.file(2), None)
+	other = index.parse('locations.cpp', unsaved_files=[('locations.cpp', '#include "tests/enumeration.hpp"\n')])
+	equals(other.file('tests/enumeration.hpp') is f, False)
+	other.reparse()
+	del other
+	equals(tu.file('tests/enumeration.hpp') is f, True)
+
+def test_LineTable():
+	table = libclang.LineTable('ab\ncd\n\nef')
+	equals(len(table), 4)
+	equals(list(table.starts), [0, 3, 6, 7])
+	equals(table.location(0), (1, 1))
+	equals(table.location(2), (1, 3))
+	equals(table.location(3), (2, 1))
+	equals(table.location(6), (3, 1))
+	equals(table.location(8), (4, 2))
+	equals(table.offset(2, 2), 4)
+	equals(table.offset(4, 1), 7)
+	equals(list(libclang.LineTable(bytearray(b'a\nb')).starts), [0, 2])
+	for line, column in [(0, 1), (5, 1), (1, 0), (1, 4), (4, 4)]:
+		try:
+			table.offset(line, column)
+			equals('ValueError', None)
+		except ValueError:
+			pass
+	equals(table.offset(1, 3), 2)
+	equals(table.offset(4, 3), 9)
+	try:
+		table.location(10)
+		equals('ValueError', None)
+	except ValueError:
+		pass
+	# file
+	index = libclang.Index()
+	tu = index.parse('tests/lines.cpp', unsaved_files=[('tests/lines.cpp', '#include "enumeration.hpp"\n\nint x;\n')])
+	f = tu.file('tests/enumeration.hpp')
+	equals(f is tu.file('tests/enumeration.hpp'), True)
+	equals(tu.line_table(f) is f.line_table, True)
+	for c, depth in tu.walk():
+		table = tu.line_table(c.location.file)
+		equals(table.location(c.location.offset), (c.location.line, c.location.column))
+		equals(table.offset(c.location.line, c.location.column), c.location.offset)
+	table = tu.line_table('tests/lines.cpp')
+	equals(list(table.starts), [0, 27, 28, 35])
+	equals(tu.file('tests/lines.cpp').line_table is table, True)
+	tu.reparse([('tests/lines.cpp', 'int x;\n')])
+	equals(list(tu.line_table('tests/lines.cpp').starts), [0, 7])
+	equals(list(tu.file('tests/lines.cpp').line_table.starts), [0, 7])
+	contents = bytearray(b'int y;\n\nint z;\n')
+	tu = index.parse('tests/lines.cpp', unsaved_files=[('tests/lines.cpp', contents)])
+	equals(list(tu.file('tests/lines.cpp').line_table.starts), [0, 7, 8, 15])
+	tu.reparse([('tests/lines.cpp', io.BytesIO(b'int w;\nint v;\n'))])
+	equals(list(tu.file('tests/lines.cpp').line_table.starts), [0, 7, 14])
+
+def test_CursorIndex():
+	index = libclang.Index()
+	contents = '#include "enumeration.hpp"\nint f(int a) {\n\treturn a;\n}\nint g() { return 1; }\n'
+	tu = index.parse('tests/index.cpp', unsaved_files=[('tests/index.cpp', contents)])
+	ci = tu.cursor_index('tests/index.cpp')
+	equals(ci.file.name, 'tests/index.cpp')
+	equals(len(ci) > 0, True)
+	equals(list(ci.starts), sorted(ci.starts))
+	for c in ci.cursors:
+		equals(c.location.file.name, 'tests/index.cpp')
+	equals(ci.at(0), None)
+	f = ci.at(contents.index('int f'))
+	equals(f.kind, libclang.CursorKind.FUNCTION_DECL)
+	equals(f.spelling, 'f')
+	a = ci.at(contents.index('a) {'))
+	equals(a.kind, libclang.CursorKind.PARM_DECL)
+	ref = ci.at(contents.index('a;'))
+	equals(ref.spelling, 'a')
+	equals(ref.kind.is_expression, True)
+	equals(ci.at(tu.location('tests/index.cpp', 3, 9)), ref)
+	equals(ci.enclosing(contents.index('a;'), [libclang.CursorKind.FUNCTION_DECL]), f)
+	equals(ci.enclosing(contents.index('a;'), [libclang.CursorKind.COMPOUND_STMT]).kind, libclang.CursorKind.COMPOUND_STMT)
+	equals(ci.enclosing(contents.index('a;'), [libclang.CursorKind.STRUCT_DECL]), None)
+	equals(ci.enclosing(contents.index('int f'), [libclang.CursorKind.FUNCTION_DECL], len(contents)), None)
+	equals([c.spelling for c in ci.overlapping(0, len(contents)) if c.kind == libclang.CursorKind.FUNCTION_DECL], ['f', 'g'])
+	equals([c.spelling for c in ci.overlapping(contents.index('}'), contents.index('}') + 3) if c.kind == libclang.CursorKind.FUNCTION_DECL], ['f', 'g'])
+	g = [c for c in tu.cursor().children if c.spelling == 'g'][0]
+	equals([c.spelling for c in ci.overlapping(g.extent) if c.kind == libclang.CursorKind.FUNCTION_DECL], ['g'])
+	equals(ci.overlapping(0, 1), [])
+	ci = tu.cursor_index('tests/enumeration.hpp')
+	equals(ci.at(0).kind, libclang.CursorKind.ENUM_DECL)
+
+def test_parse_many():
+	files = ['tests/enumeration.hpp', 'tests/error.hpp', ('tests/enumeration.hpp', ['-std=c++98']), ('tests/error.hpp', [1])]
+	results = list(libclang.parse_many(files, workers=2))
+	equals(len(results), 4)
+	equals(sorted([r.filename for r in results]), ['tests/enumeration.hpp', 'tests/enumeration.hpp', 'tests/error.hpp', 'tests/error.hpp'])
+	errors = [r for r in results if r.error is not None]
+	equals(len(errors), 1)
+	equals(errors[0].tu, None)
+	equals(isinstance(errors[0].error, AttributeError), True)
+	for filename, tu, error in results:
+		if error is not None:
+			continue
+		equals(tu.spelling, filename)
+		if filename == 'tests/error.hpp':
+			equals(len(list(tu.diagnostics)), 1)
+		else:
+			equals(len(list(tu.diagnostics)), 0)
+	# unable to parse
+	results = list(libclang.parse_many(['tests/does-not-exist.cpp'], workers=1))
+	equals(results[0].tu, None)
+	equals(str(results[0].error), 'Unable to parse tests/does-not-exist.cpp.')
+	# no workers
+	try:
+		list(libclang.parse_many(files, workers=0))
+		equals('ValueError', None)
+	except ValueError:
+		pass
+
+def test_index_many():
+	files = ['tests/enumeration.hpp', 'tests/error.hpp', ('tests/enumeration.hpp', ['-std=c++98'])]
+	results = sorted(libclang.index_many(files, testworkers.count_cursors, workers=2))
+	equals(len(results), 3)
+	equals([r.filename for r in results], ['tests/enumeration.hpp', 'tests/enumeration.hpp', 'tests/error.hpp'])
+	equals(results[0].value, results[1].value)
+	equals(results[0].diagnostics, [])
+	equals(results[0].error, None)
+	equals(results[2].diagnostics, ['tests/error.hpp:3:2: error: expected \';\' after struct'])
+	results = list(libclang.index_many(files, testworkers.exit_worker, workers=2))
+	equals(len(results), 3)
+	for r in results:
+		equals(r.value, None)
+		equals(r.error, 'Worker exited with code 3.')
+	# workers that exit while idle are replaced without failing the next job
+	def jobs():
+		yield 'tests/enumeration.hpp'
+		for process in multiprocessing.active_children():
+			process.terminate()
+			process.join()
+		yield 'tests/enumeration.hpp'
+	results = list(libclang.index_many(jobs(), testworkers.count_cursors, workers=1))
+	equals([r.error for r in results], [None, None])
+	equals(results[0].value, results[1].value)
+
+def test_CompilationDatabase():
+	directory = os.path.join(os.getcwd(), 'tests')
+	commands = [
+		{ 'directory': directory, 'command': 'c++ -std=c++98 -DX="a b" -o enumeration.o -c enumeration.hpp', 'file': 'enumeration.hpp' },
+		{ 'directory': directory, 'arguments': ['c++', '-std=c++98', '-DX=a b', '-oerror.o', '-c', 'error.hpp'], 'file': 'error.hpp' },
+	]
+	filename = os.path.join(tempfile.mkdtemp(), 'compile_commands.json')
+	with open(filename, 'w') as f:
+		json.dump(commands, f, indent=2)
+	db = libclang.CompilationDatabase(filename)
+	db.chunk_size = 16
+	commands = list(db)
+	equals(len(commands), 2)
+	equals(commands[0].filename, os.path.join(directory, 'enumeration.hpp'))
+	equals(commands[0].args, ('-std=c++98', '-DX=a b'))
+	equals(commands[0].directory, directory)
+	equals(commands[1].filename, os.path.join(directory, 'error.hpp'))
+	equals(commands[1].args is commands[0].args, True)
+	tus = dict([(r.filename, r.tu) for r in db.parse(workers=2)])
+	equals(len(tus), 2)
+	equals(len(list(tus[commands[0].filename].diagnostics)), 0)
+	equals(len(list(tus[commands[1].filename].diagnostics)), 1)
+	equals(sorted(db.costs.keys()), [commands[0].filename, commands[1].filename])
+	db.costs[commands[0].filename] = 0
+	db.costs[commands[1].filename] = 1
+	equals([c.filename for c in db.jobs()], [commands[1].filename, commands[0].filename])
+	costs = os.path.join(os.path.dirname(filename), 'costs.json')
+	db.save_costs(costs)
+	db = libclang.CompilationDatabase(filename)
+	db.load_costs(costs)
+	equals(db.costs, { commands[0].filename: 0, commands[1].filename: 1 })
+	# arguments
+	commands = [
+		{ 'directory': directory, 'arguments': ['c++', '-Iinclude', '-isystem', 'sys', '-I/usr/include', '-objcmt-migrate-literals', '-o', 'a.o', '-c', './enumeration.hpp'], 'file': 'enumeration.hpp' },
+	]
+	with open(filename, 'w') as f:
+		json.dump(commands, f)
+	commands = list(libclang.CompilationDatabase(filename))
+	equals(commands[0].args, ('-I' + os.path.join(directory, 'include'), '-isystem', os.path.join(directory, 'sys'), '-I/usr/include', '-objcmt-migrate-literals'))
+	equals(os.getcwd(), os.path.dirname(directory))
+	# dependency files and duplicate entries
+	commands = [
+		{ 'directory': directory, 'arguments': ['c++', '-MD', '-MF', 'dep.d', '-MT', 'dep.o', '-MQ', 'dep.o', '-MMD', '-MFdep2.d', '-MP', '-mno-sse', '-c', 'enumeration.hpp'], 'file': 'enumeration.hpp' },
+		{ 'directory': directory, 'arguments': ['c++', '-MD', '-MF', 'dep.d', '-MT', 'dep.o', '-MQ', 'dep.o', '-MMD', '-MFdep2.d', '-MP', '-mno-sse', '-c', 'enumeration.hpp'], 'file': './enumeration.hpp' },
+	]
+	with open(filename, 'w') as f:
+		json.dump(commands, f)
+	db = libclang.CompilationDatabase(filename)
+	commands = list(db)
+	equals(len(commands), 1)
+	equals(commands[0].args, ('-mno-sse',))
+	equals([r.error for r in db.parse(workers=1)], [None])
+	for name in ['dep.d', 'dep2.d', os.path.join('tests', 'dep.d'), os.path.join('tests', 'dep2.d')]:
+		equals(os.path.exists(name), False)
+
+def test_ASTCache():
+	index = libclang.Index()
+	directory = tempfile.mkdtemp()
+	filename = os.path.join(directory, 'cached.hpp')
+	with open(filename, 'w') as f:
+		f.write('struct cached {};')
+	cache = libclang.ASTCache(os.path.join(directory, 'cache'))
+	tu = cache.parse(index, filename, ['-std=c++98'])
+	equals([f.name for f in tu.included_files], [filename])
+	equals((cache.hits, cache.misses), (0, 1))
+	tu = cache.parse(index, filename, ['-std=c++98'])
+	equals((cache.hits, cache.misses), (1, 1))
+	equals([c.spelling for c in tu.cursor().children], ['cached'])
+	tu = cache.parse(index, filename, ['-std=c++11'])
+	equals((cache.hits, cache.misses), (1, 2))
+	with open(filename, 'w') as f:
+		f.write('struct changed {};')
+	tu = cache.parse(index, filename, ['-std=c++98'])
+	equals((cache.hits, cache.misses), (1, 3))
+	equals([c.spelling for c in tu.cursor().children], ['changed'])
+	tu = cache.parse(index, 'tests/error.hpp')
+	tu = cache.parse(index, 'tests/error.hpp')
+	equals((cache.hits, cache.misses), (1, 5))
+	equals(len(list(tu.diagnostics)), 1)
+	# options
+	tu = cache.parse(index, filename, ['-std=c++98'], libclang.TranslationUnitFlags.INCOMPLETE)
+	equals((cache.hits, cache.misses), (1, 6))
+	# unsaved files and diagnostics
+	unsaved = os.path.join(directory, 'unsaved.cpp')
+	tu = cache.parse(index, unsaved, ['-Wunused-value'], unsaved_files=[(unsaved, 'void f() { 1; }')])
+	equals((cache.hits, cache.misses), (1, 7))
+	tu = cache.parse(index, unsaved, ['-Wunused-value'], unsaved_files=[(unsaved, b'void f() { 1; }')])
+	equals((cache.hits, cache.misses), (2, 7))
+	equals(list(tu.diagnostics), [])
+	diagnostics = tu.diagnostics_snapshot()
+	equals([(d.severity, d.filename, d.line, d.column, d.option) for d in diagnostics],
+	       [(libclang.DiagnosticSeverity.WARNING, unsaved, 1, 12, '-Wunused-value')])
+	equals(tu.diagnostics_snapshot(libclang.DiagnosticSeverity.ERROR), [])
+	tu = cache.parse(index, unsaved, ['-Wunused-value'], unsaved_files=[(unsaved, 'void g() { 1; }')])
+	equals((cache.hits, cache.misses), (2, 8))
+	# size
+	entries = [name for name in os.listdir(cache.directory) if name.endswith('.ast')]
+	equals(cache.size, sum([os.path.getsize(os.path.join(cache.directory, name)) for name in entries]))
+	cache.max_size = 0
+	cache.evict()
+	equals(cache.evictions, len(entries))
+	equals(cache.size, 0)
+	equals(index.from_ast(os.path.join(directory, 'missing.ast')), None)
 
 def test_Diagnostic():
 	index = libclang.Index()
@@ -531,6 +954,34 @@ def test_Diagnostic29():
 	equals(d.disable_option, '')
 	equals(d.category.name, 'Parse Issue')
 	equals(d.category_text, 'Parse Issue')
+	# snapshot
+	r = tu.diagnostics_snapshot()[0]
+	equals(r.option, '')
+	equals(r.category, 'Parse Issue')
+
+def test_DiagnosticRecord():
+	index = libclang.Index()
+	tu = index.parse('tests/error.hpp')
+	diagnostics = tu.diagnostics_snapshot()
+	equals(len(diagnostics), 1)
+	r = diagnostics[0]
+	equals(r.severity, libclang.DiagnosticSeverity.ERROR)
+	equals((r.filename, r.line, r.column), ('tests/error.hpp', 3, 2))
+	equals(r.spelling, 'expected \';\' after struct')
+	equals(r.ranges, [])
+	equals(r.fixits, [(((3, 2), (3, 2)), ';')])
+	# severity
+	tu = index.parse('tests/warning.cpp', args=['-Wsign-compare'], unsaved_files=[('tests/warning.cpp', """int f(unsigned a, int b) {
+		return a < b;
+	}
+	int g() { return undefined; }""")])
+	diagnostics = tu.diagnostics_snapshot()
+	equals([(r.severity, r.line) for r in diagnostics],
+	       [(libclang.DiagnosticSeverity.WARNING, 2), (libclang.DiagnosticSeverity.ERROR, 4)])
+	equals(diagnostics[0].ranges, [((2, 10), (2, 11)), ((2, 14), (2, 15))])
+	diagnostics = tu.diagnostics_snapshot(libclang.DiagnosticSeverity.ERROR)
+	equals([(r.severity, r.line) for r in diagnostics], [(libclang.DiagnosticSeverity.ERROR, 4)])
+	equals(tu.diagnostics_snapshot(libclang.DiagnosticSeverity.FATAL), [])
 
 def test_Cursor():
 	c = parse_str('enum test { a, b };', filename='tests/enumeration.hpp')[0]
@@ -540,6 +991,10 @@ def test_Cursor():
 	equals(c != libclang.Cursor.null(), True)
 	equals(c.is_null, False)
 	equals(hash(c), hash(c))
+	equals(libclang.Cursor.null().is_null, True)
+	equals(libclang.Cursor.null() is libclang.Cursor.null(), True)
+	equals(c == None, False)
+	equals(len(set([c, c.canonical, c.definition, libclang.Cursor.null()])), 2)
 	equals(c.spelling, 'test')
 	equals(str(c), 'test')
 	equals(c.kind, libclang.CursorKind.ENUM_DECL)
@@ -547,7 +1002,7 @@ def test_Cursor():
 	equals(c.linkage, libclang.Linkage.EXTERNAL)
 	match_location(c.location, 'tests/enumeration.hpp', 1, 6, 5)
 	match_location(c.extent.start, 'tests/enumeration.hpp', 1, 1, 0)
-	match_location(c.extent.end, 'tests/enumeration.hpp', 1, 1, 0)
+	match_location(c.extent.end, 'tests/enumeration.hpp', 1, 19, 18)
 	equals(c.usr, 'c:@E@test')
 	equals(c.referenced, c)
 	equals(c.definition, c)
@@ -580,6 +1035,17 @@ def test_Cursor():
 		match_tokens(f.tokens, ['void', 'f', '(', 'int', 'x', ',', 'int', 'y', ')', ';'])
 	match_tokens(x.tokens, ['int', 'x', ','])
 	match_tokens(y.tokens, ['int', 'y', ')'])
+	# walk
+	c = parse_str('struct x { struct y { int a; }; int b; };')[0]
+	y, b = c.children
+	a = y.children[0]
+	equals(c.walk(), [(y, 1), (a, 2), (b, 1)])
+	equals([(n.spelling, depth) for n, depth in c.walk()], [('y', 1), ('a', 2), ('b', 1)])
+	equals([n for n, depth in c.walk()], [y, a, b])
+	equals(a.parent, y)
+	equals([(n.spelling, depth) for n, depth in c.walk(kinds=[libclang.CursorKind.FIELD_DECL])], [('a', 2), ('b', 1)])
+	equals([n.spelling for n, depth in c.walk(prune=[libclang.CursorKind.STRUCT_DECL])], ['y', 'b'])
+	equals([n.parent for n, depth in c.walk(kinds=[libclang.CursorKind.FIELD_DECL])], [y, c])
 
 def test_Cursor28():
 	c = parse_str('enum test {};')[0]
@@ -591,6 +1057,25 @@ def test_Cursor28():
 	equals(c.template_kind, libclang.CursorKind.NO_DECL_FOUND)
 	equals(c.specialized_template.kind, libclang.CursorKind.INVALID_FILE)
 	equals(c.is_virtual_base, False)
+	# walk -- deeply nested expressions
+	c = parse_str('int x = 1%s;' % ('+1' * 2000))[0]
+	literals = c.walk(kinds=[libclang.CursorKind.INTEGER_LITERAL])
+	equals(len(literals), 2001)
+	equals(literals[0][1], 2001)
+	# walk -- errors raised while visiting the cursors are propagated
+	cursor_key = libclang._cursor_key
+	def failing_cursor_key(c):
+		if c.kind == libclang.CursorKind.INTEGER_LITERAL.value:
+			raise ValueError('visit failed')
+		return cursor_key(c)
+	libclang._cursor_key = failing_cursor_key
+	try:
+		c.walk()
+		equals('ValueError', None)
+	except ValueError as e:
+		equals(str(e), 'visit failed')
+	finally:
+		libclang._cursor_key = cursor_key
 
 def test_Cursor29():
 	c = parse_str('enum test { a };')[0]
@@ -609,7 +1094,7 @@ def test_Cursor30():
 	equals(c.is_virtual, False)
 	rng = c.reference_name_range(libclang.NameRefFlags.WANT_TEMPLATE_ARGS, 0)
 	match_location(rng.start, 'cursor30.hpp', 1, 1, 0)
-	match_location(rng.end, 'cursor30.hpp', 1, 1, 0)
+	match_location(rng.end, 'cursor30.hpp', 1, 13, 12)
 
 def test_Cursor31():
 	c = parse_str('enum test { a = 7 };', filename='cursor31.hpp')[0]
@@ -617,7 +1102,7 @@ def test_Cursor31():
 	equals(c.objc_selector_index, -1)
 	rng = c.spelling_name_range(libclang.NameRefFlags.WANT_TEMPLATE_ARGS, 0)
 	match_location(rng.start, 'cursor31.hpp', 1, 6, 5)
-	match_location(rng.end, 'cursor31.hpp', 1, 6, 5)
+	match_location(rng.end, 'cursor31.hpp', 1, 10, 9)
 
 def test_Cursor32():
 	c = parse_str('enum test {};', filename='cursor32.hpp')[0]
@@ -639,6 +1124,11 @@ def test_Cursor33():
 def test_Cursor34():
 	c = parse_str('enum test {};', filename='cursor34.hpp')[0]
 	equals(c.is_objc_optional, False)
+	index = libclang.Index()
+	tu = index.parse('walk34.cpp', unsaved_files=[
+		('walk34.cpp', '#include "tests/enumeration.hpp"\nstruct x { int a; };')])
+	equals([c.spelling for c, depth in tu.walk(main_file=True)], ['x', 'a'])
+	equals([c.spelling for c, depth in tu.walk(files=['tests/enumeration.hpp'])], ['test', 'a', 'b', 'c'])
 
 def test_StructDecl27():
 	x = parse_str('struct x { int a; };')[0]
@@ -989,6 +1479,9 @@ def test_TemplateTypeParameter28():
 	match_cursor(t, libclang.CursorKind.TEMPLATE_TYPE_PARAMETER)
 	match_type(t.type, libclang.TypeKind.UNEXPOSED, t) # FIXME
 	equals(t.access_specifier, libclang.AccessSpecifier.INVALID)
+	w = [c for c, depth in x.walk(kinds=[libclang.CursorKind.TEMPLATE_TYPE_PARAMETER])]
+	equals([c.kind for c in w], [libclang.CursorKind.TEMPLATE_TYPE_PARAMETER])
+	equals(w[0].access_specifier, libclang.AccessSpecifier.INVALID)
 
 def test_NonTypeTemplateParameter28():
 	x = parse_str('template<int T> struct x {};')[0]
@@ -1034,6 +1527,8 @@ def test_CxxNullPtrLiteralExpr28():
 	a = e.children[0]
 	match_cursor(a, libclang.CursorKind.CXX_NULLPTR_LITERAL_EXPR)
 	equals(a.access_specifier, libclang.AccessSpecifier.INVALID)
+	equals([(c.kind, depth) for c, depth in x.walk(kinds=[libclang.CursorKind.CXX_NULLPTR_LITERAL_EXPR])], [(libclang.CursorKind.CXX_NULLPTR_LITERAL_EXPR, 2)])
+	equals([(c.kind, depth) for c, depth in x.walk(kinds=[libclang.CursorKind.UNEXPOSED_EXPR])], [(libclang.CursorKind.UNEXPOSED_EXPR, 1)])
 	# type
 	t = a.type
 	match_type(t, libclang.TypeKind.NULLPTR, a)
@@ -1048,6 +1543,10 @@ def test_LinkageSpec30():
 	match_cursor(s, libclang.CursorKind.LINKAGE_SPEC)
 	match_type(s.type, libclang.TypeKind.INVALID, s)
 	equals(s.access_specifier, libclang.AccessSpecifier.INVALID)
+	# walk
+	tu = s.parent
+	equals([c for c, depth in tu.walk(kinds=[libclang.CursorKind.LINKAGE_SPEC])], [s])
+	equals([c for c, depth in tu.walk(kinds=[libclang.CursorKind.UNEXPOSED_DECL])], [])
 
 def test_TypeAliasDecl30():
 	x, y = parse_str('struct x {}; using y = x;', args=['-std=c++11'])
@@ -1316,8 +1815,61 @@ def test_Token():
 	equals(token.location, tu.location(f, 1, 1))
 	match_location(token.location, 'tests/enumeration.hpp', 1, 1, 0)
 	match_location(token.extent.start, 'tests/enumeration.hpp', 1, 1, 0)
-	match_location(token.extent.end, 'tests/enumeration.hpp', 1, 1, 0)
+	match_location(token.extent.end, 'tests/enumeration.hpp', 1, 5, 4)
 	equals(token.cursor, children[0])
+	# annotate
+	tokens = tu.tokenize(tu.cursor().extent)
+	cursors = tokens.annotate()
+	equals(len(cursors), len(tokens))
+	equals(cursors[0], children[0])
+	equals(cursors[1], children[0])
+	equals(cursors[3].kind, libclang.CursorKind.ENUM_CONSTANT_DECL)
+	equals(cursors[3].spelling, 'a')
+	equals(tokens[3].cursor is cursors[3], True)
+	equals(tokens[-1].cursor is cursors[-1], True)
+	equals(tu.tokenize(libclang.SourceRange.null()).annotate(), [])
+	# batch accessors
+	equals(list(tokens.kinds()), [t.kind.value for t in tokens])
+	equals(tokens.spellings(), ['enum', 'test', '{', 'a', ',', 'b', ',', 'c', ',', '}', ';'])
+	equals(tokens.spellings()[4] is tokens.spellings()[6], True)
+	equals(list(tokens.lines()), [1, 1, 2, 3, 3, 4, 4, 5, 5, 6, 6])
+	equals(list(tokens.columns()), [1, 6, 1, 2, 3, 2, 3, 2, 3, 1, 2])
+	equals(list(tokens.offsets()), [t.location.offset for t in tokens])
+	equals(tokens.match(4, libclang.TokenKind.PUNCTUATION, ','), True)
+	equals(tokens.match(4, libclang.TokenKind.PUNCTUATION, ';'), False)
+	empty = tu.tokenize(libclang.SourceRange.null())
+	equals((len(empty.kinds()), empty.spellings(), len(empty.lines())), (0, [], 0))
+
+def test_TokenPattern():
+	index = libclang.Index()
+	tu = index.parse('pattern.cpp', unsaved_files=[('pattern.cpp', 'int a = 1, b, c = 2; int AB;')])
+	tokens = tu.tokenize(tu.cursor().extent)
+	K = libclang.TokenKind
+	P = libclang.TokenPattern
+	# sequence
+	pattern = P((K.KEYWORD, 'int'), K.IDENTIFIER)
+	equals([(m.start, m.end) for m in pattern.scan(tokens)], [(0, 2), (11, 13)])
+	equals(pattern.match(tokens).end, 2)
+	equals(pattern.match(tokens, 1), None)
+	equals(pattern.match(tokens, 11).start, 11)
+	equals(pattern.match(tokens, len(tokens)), None)
+	# spelling only; tokens inside a spelling are not matched
+	equals([m.start for m in P('b').scan(tokens)], [5])
+	equals([m.start for m in P('B').scan(tokens)], [])
+	# optional and capture
+	pattern = P(P.capture('name', K.IDENTIFIER), P.optional((K.PUNCTUATION, '='), P.capture('value', K.LITERAL)))
+	matches = list(pattern.scan(tokens))
+	equals([(m.start, m.end) for m in matches], [(1, 4), (5, 6), (7, 10), (12, 13)])
+	equals(matches[0].captures, { 'name': (1, 2), 'value': (3, 4) })
+	equals(matches[1].captures, { 'name': (5, 6), 'value': None })
+	# repeat
+	declarator = [K.IDENTIFIER, P.optional('=', K.LITERAL)]
+	pattern = P('int', P.capture('first', declarator), P.repeat([',', declarator], 1), ';')
+	matches = list(pattern.scan(tokens))
+	equals([(m.start, m.end) for m in matches], [(0, 11)])
+	equals(matches[0].captures['first'], (1, 4))
+	equals([(m.start, m.end) for m in P(P.repeat(K.PUNCTUATION, 2, 2)).scan(tokens)], [])
+	equals([(m.start, m.end) for m in P(P.repeat(K.IDENTIFIER, 0, 1)).scan(tokens)], [(1, 2), (5, 6), (7, 8), (12, 13)])
 
 def test_Type28():
 	c = parse_str('int a;')[0]
@@ -1332,6 +1884,25 @@ def test_Type28():
 	equals(t.canonical_type, t)
 	equals(t.canonical_type.cursor, c)
 	match_type(t.pointee_type, libclang.TypeKind.INVALID, c)
+	equals(t.pointee_type.cursor, c)
+	equals(t.pointee_type is t.result_type, False)
+	equals(t == None, False)
+	# shared types
+	a, b, f = parse_str('int a; int b; long f(int x);')
+	equals(a.type == b.type, True)
+	equals(a.type.cursor, a)
+	equals(b.type.cursor, b)
+	equals(f.type.result_type == a.type, False)
+	equals(len(set([a.type, b.type, f.type.result_type.canonical_type])), 2)
+	s, a, b = parse_str('struct s {}; s a; s b;')
+	equals(a.type.declaration is b.type.declaration, True)
+	equals(a.type.declaration, s)
+	g = parse_str('template <typename T> T g(T t);')[0]
+	equals(g.type.result_type.cursor, g)
+	p = g.children[-1]
+	equals(p.type == g.type.result_type, True)
+	match_type(p.type, libclang.TypeKind.UNEXPOSED, p)
+	match_type(p.type.pointee_type, libclang.TypeKind.INVALID, p)
 	match_type(t.result_type, libclang.TypeKind.INVALID, c)
 	equals(t.declaration.kind, libclang.CursorKind.NO_DECL_FOUND)
 	equals(t.is_pod, True)
@@ -1372,6 +1943,48 @@ def test_Type35():
 	t = c.type
 	equals(len(list(t.template_arguments)), 0)
 
+def test_RecordLayout33():
+	s, x, f, xi = parse_str("""
+		struct s { char a; int b : 3; int : 2; union { int c; float d; }; struct { short e; } n; double g; };
+		template <typename T> struct x { T t; };
+		struct f;
+		x<int> xi;""")
+	# s
+	layout = s.type.layout()
+	equals(layout.type, s.type)
+	equals(layout.size, 24)
+	equals(layout.alignment, 8)
+	equals([(m.field.spelling, m.offset, m.bit_width) for m in layout.fields if m.field.spelling],
+	       [('a', 0, None), ('b', 8, 3), ('c', 32, None), ('d', 32, None), ('n', 64, None), ('g', 128, None)])
+	# unnamed bit-fields only have an offset with clang_Cursor_getOffsetOfField (3.7)
+	equals((layout.fields[2].field.spelling, layout.fields[2].bit_width), ('', 2))
+	equals(layout.fields[2].offset in (None, 11), True)
+	equals(layout.fields[0].type.kind, libclang.TypeKind.CHAR_S)
+	equals(s.type.layout() is layout, True)
+	# x<int> -- implicit template instantiation
+	layout = xi.type.layout()
+	equals(layout.size, 4)
+	equals([(m.field.spelling, m.offset, m.bit_width) for m in layout.fields], [('t', 0, None)])
+	# not a complete record
+	equals(x.type.layout(), None)
+	equals(f.type.layout(), None)
+	equals(layout.fields[0].field.type.layout(), None)
+	# translation unit
+	layouts = list(s.translation_unit.record_layouts())
+	equals([l.size for l in layouts], [24, 4, 2])
+	equals(layouts[0] is s.type.layout(), True)
+	equals([(m.field.spelling, m.offset) for m in layouts[1].fields], [('c', 0), ('d', 0)])
+	# record_layouts -- records that have not been laid out yet
+	s, r = parse_str("""
+		struct s { struct { int a; }; struct t { int b; } c; int d; };
+		struct r { int e; };""")
+	layouts = list(s.translation_unit.record_layouts())
+	equals([l.size for l in layouts], [12, 4, 4, 4])
+	equals([(m.field.spelling, m.offset) for m in layouts[0].fields], [('a', 0), ('c', 32), ('d', 64)])
+	equals([(m.field.spelling, m.offset) for m in layouts[2].fields], [('b', 0)])
+	equals(layouts[0] is s.type.layout(), True)
+	equals(layouts[3] is r.type.layout(), True)
+
 def test_builtin_type(program, kind, args=None, ignore_errors=False, signed=False, unsigned=False, floating_point=False):
 	c = parse_str(program, args=args, ignore_errors=ignore_errors)[0]
 	t = c.type
@@ -1510,6 +2123,7 @@ run(3.0, test_NameRefFlags30)
 run(2.8, test_TranslationUnitFlags28)
 run(2.8, test_SaveTranslationUnitFlags28)
 run(2.8, test_ReparseTranslationUnitFlags28)
+run(3.0, test_TUResourceUsageKind30)
 run(3.1, test_GlobalOptionFlags31)
 run(3.1, test_CallingConvention31)
 run(3.3, test_ObjCPropertyAttributes33)
@@ -1518,10 +2132,22 @@ run(3.4, test_RefQualifierKind34)
 run(2.7, test_Index)
 run(3.1, test_Index31)
 run(2.7, test_TranslationUnit)
+run(2.8, test_TranslationUnit28)
+run(2.8, test_EditSession28)
 run(2.9, test_TranslationUnit29)
 run(3.0, test_TranslationUnit30)
+run(3.0, test_TranslationUnitPool30)
+run(2.7, test_ASTSnapshot)
+run(2.7, test_decode_locations)
+run(2.8, test_LineTable)
+run(2.7, test_CursorIndex)
+run(2.7, test_parse_many)
+run(2.7, test_index_many)
+run(2.7, test_CompilationDatabase)
+run(2.8, test_ASTCache)
 run(2.7, test_Diagnostic)
 run(2.9, test_Diagnostic29)
+run(2.7, test_DiagnosticRecord)
 run(2.7, test_Cursor)
 run(2.8, test_Cursor28)
 run(2.9, test_Cursor29)
@@ -1588,12 +2214,14 @@ run(2.9, test_LabelRef29)
 run(2.9, test_OverloadedDeclRef29)
 run(3.1, test_VariableRef31)
 run(2.7, test_Token)
+run(2.7, test_TokenPattern)
 run(2.8, test_Type28)
 run(2.9, test_Type29)
 run(3.0, test_Type30)
 run(3.1, test_Type31)
 run(3.3, test_Type33)
 run(3.5, test_Type35)
+run(3.3, test_RecordLayout33)
 run(2.8, test_BuiltinType28)
 run(3.1, test_BuiltinType31)
 run(3.4, test_FunctionProtoType34)
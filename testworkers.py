@@ -0,0 +1,28 @@
+# Copyright (C) 2014 Reece H. Dunn
+#
+# This file is part of libclangpy.
+#
+# libclangpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# libclangpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with libclangpy.  If not, see <http://www.gnu.org/licenses/>.
+
+# The functions run by the index_many worker processes in tests.py. These
+# are in a separate module as the worker processes import the module the
+# function is defined in, and importing tests.py runs the tests.
+
+import os
+
+def count_cursors(tu):
+	return len(list(tu.walk()))
+
+def exit_worker(tu):
+	os._exit(3)